@@ -1,6 +1,25 @@
+import os
+import sys
+import csv
+import json
+import heapq
+import argparse
 import time
+import shutil
+import zipfile
 import calendar
+import cProfile
+import contextlib
+import tracemalloc
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (Windows): concurrent processes may rebuild a cache at the same time
+    fcntl = None
 
 # define potential user input - available cities (csvs), months (data in csvs), weekday data (all), show_rows
 # optionality
@@ -13,111 +32,1985 @@ MONTH_DATA = ['january', 'february', 'march', 'april', 'may', 'june', 'all']
 WEEKDAY_DATA = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'all']
 SHOW_ROWS = ['yes', 'no']
 
+# parsed city data is cached as one .npy file per column below this directory (one sub directory per city and
+# build of its cache), bump the version whenever the cache layout changes so outdated caches get rebuilt
+CACHE_DIR = '.bikeshare_cache'
+CACHE_VERSION = 7
+
+# compact dtypes used for the city data: text columns with few distinct values are dictionary encoded
+# (categorical), missing columns (Gender and Birth Year in Washington) are skipped by read_csv
+CSV_DTYPES = {'Start Station': 'category', 'End Station': 'category', 'User Type': 'category',
+              'Gender': 'category', 'Birth Year': np.float32}
+
+# layout of the Start Time and End Time values in the city csv files, e.g. "2017-01-01 00:07:57"
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# month, hour and weekday of rows without a Start Time, matches no month or day filter and is never counted
+MISSING_TIME = -1
+
+# city files larger than this are streamed in chunks of STREAM_CHUNKSIZE rows instead of being loaded at once
+STREAM_THRESHOLD_BYTES = 1 << 30
+STREAM_CHUNKSIZE = 200000
+
+# columns read by aggregate, the only ones workers need to load
+STATS_COLUMNS = ['month', 'hour', 'day_of_week', 'Start Station', 'End Station', 'Trip Duration', 'User Type',
+                 'Gender', 'Birth Year']
+
+# ways to compute the statistics of a query, see get_stats (streaming reads the csv per query, so batches
+# use the other modes, and stream only files larger than STREAM_THRESHOLD_BYTES, once for all of their queries)
+QUERY_MODES = ['cube', 'memory', 'stream', 'parallel']
+BATCH_MODES = ['cube', 'memory', 'parallel']
+
+# metrics behind each display function, used to report the time spent computing them
+SECTION_METRICS = {'time_stats': ['month', 'day_of_week', 'hour'],
+                   'station_stats': ['stations', 'start_station', 'end_station', 'trip'],
+                   'trip_duration_stats': ['duration'],
+                   'user_stats': ['user_type', 'gender', 'birth_year']}
+
+# finished instrumentation spans of this process (the most recent ones), spans are also written as JSON lines
+# to TRACE_OUT once enable_trace has been called
+SPANS = deque(maxlen=10000)
+SPAN_STACK = []
+TRACE_OUT = None
+
+# cities whose cache lock this process holds, see cache_lock
+CACHE_LOCKS = set()
+
+# count tables kept per (month, weekday) cell in the rollup cube, with the column name they count
+CUBE_TABLES = {'month': 'month', 'hour': 'hour', 'day_of_week': 'day_of_week', 'start_station': 'Start Station',
+               'end_station': 'End Station', 'user_type': 'User Type', 'gender': 'Gender', 'birth_year': 'Birth Year'}
+
+# aggregates of recent queries by (city, month, day, csv fingerprint), least recently used first; at most
+# RESULT_CACHE_SIZE of them holding at most RESULT_CACHE_ENTRIES count table entries (an "all" query of a large
+# city alone holds one entry per station pair), with RESULT_CACHE_DIR set they are also kept on disk in at most
+# RESULT_CACHE_SIZE files of at most RESULT_CACHE_DISK_BYTES together (see enable_result_cache)
+RESULT_CACHE = OrderedDict()
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_ENTRIES = 2000000
+RESULT_CACHE_DISK_BYTES = 1 << 30
+RESULT_CACHE_DIR = None
+
+# top-K tables reported by top_k and the default error bounds of its approximate method: counts are
+# overestimated by at most TOP_K_EPSILON * rows with probability 1 - TOP_K_DELTA, distinct routes are counted
+# with a relative standard error of about 1.04 / sqrt(2 ** HLL_PRECISION)
+TOP_K_TABLES = ['start_station', 'end_station', 'trip']
+TOP_K_METHODS = ['exact', 'approx']
+TOP_K_EPSILON = 0.0005
+TOP_K_DELTA = 0.01
+HLL_PRECISION = 14
+
+
+def current_rss():
+    """Returns the resident memory of this process in bytes, None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+@contextlib.contextmanager
+def span(name, rows=None):
+
+    """
+    Measures one named stage of the hot path.
+
+    The record is yielded so the stage can fill in its row count once it is known. Time comes from the
+    monotonic high resolution perf_counter clock, memory deltas from the resident memory and, while tracemalloc
+    is tracing, from the traced Python allocations.
+
+    Args:
+        (str) name - name of the stage, e.g. "csv.read" or "metric.trip"
+        (int) rows - number of rows the stage works on, if known up front
+    Returns:
+        (dict) record - span, parent span, pid, wall clock start, rows, seconds and memory deltas in bytes
+    """
+    record = {'span': name, 'parent': SPAN_STACK[-1] if SPAN_STACK else None, 'pid': os.getpid(),
+              'time': time.time(), 'rows': rows}
+    SPAN_STACK.append(name)
+    rss = current_rss()
+    traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        SPAN_STACK.pop()
+        rss_after = current_rss()
+        record['rss_delta'] = rss_after - rss if rss is not None and rss_after is not None else None
+        if traced is not None and tracemalloc.is_tracing():
+            record['traced_delta'] = tracemalloc.get_traced_memory()[0] - traced
+        SPANS.append(record)
+        if TRACE_OUT is not None:
+            TRACE_OUT.write(json.dumps(record, default=str) + '\n')
+            TRACE_OUT.flush()
+
+
+def enable_trace(path, memory=False):
+
+    """
+    Starts writing every finished span as one JSON line to a file.
+
+    Args:
+        (str) path - file to append the spans to
+        (bool) memory - whether to trace Python allocations with tracemalloc as well (slower)
+    """
+    global TRACE_OUT
+    TRACE_OUT = open(path, 'a')
+    if memory:
+        tracemalloc.start()
+
+
+def section_seconds(stats, section):
+    """Returns the time spent computing the metrics behind one display function."""
+    return sum(stats['timings'].get(key, 0.0) for key in SECTION_METRICS[section])
+
 
 def get_filters():
 
     """
-    Asks user to specify a city, month, and day to analyze.
+    Asks user to specify a city, month, and day to analyze.
+
+    Returns:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    """
+    # request user input (city, month, weekday)
+    print('Hello! Let\'s explore some US bikeshare data!')
+    city = input("Please choose which city data to analyse. Options are Chicago, New York City, Washington: ").lower()
+    cities = list(CITY_DATA.keys())
+
+    # make sure only predefined input as defined above is chosen
+    while not(city in cities):
+        city = input("Input is not part of the options Chicago, New York City, Washington, "
+                     "Must be a typo as no case sensitivity is applied. Please re-enter city name: ").lower()
+
+    month = input("Please choose which month between January and June to analyse "
+                  "or enter all to analyse all months at once: ").lower()
+    while not (month in MONTH_DATA):
+        month = input(
+            "Input is not part of the options {}. Must be a typo as no case sensitivity is applied. "
+            "Please re-enter month name: ".format(MONTH_DATA)).lower()
+
+    day = input("Please choose the weekday of interest or enter all to analyse all weekdays at once: ").lower()
+    while not (day in WEEKDAY_DATA):
+        day = input(
+            "Input is not part of the options {}. Must be a typo as no case sensitivity is applied. "
+            "Please re-enter weekday name: ".format(WEEKDAY_DATA)).lower()
+
+    print('-'*40)
+    print('get_filters done')
+    return city, month, day
+
+
+def source_fingerprint(city):
+
+    """
+    Identifies the current state of a city csv file.
+
+    Args:
+        (str) city - name of the city
+    Returns:
+        (dict) fingerprint - absolute path, size in bytes and modification time (ns) of the csv file
+    """
+    path = CITY_DATA[city]
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def city_cache_dir(city):
+    """Returns the cache directory of a city."""
+    return os.path.join(CACHE_DIR, city.replace(' ', '_'))
+
+
+def cache_build_dir(city, meta):
+    """Returns the directory holding the column files of the cache build described by meta."""
+    return os.path.join(city_cache_dir(city), meta['build'])
+
+
+@contextlib.contextmanager
+def cache_lock(city):
+
+    """
+    Holds an exclusive lock on the cache of a city, so only one process at a time (re)builds it.
+
+    Processes waiting for the lock should check again whether the cache is still outdated once they hold it,
+    another process has most likely just rebuilt it. The lock is reentrant within a process. Readers do not need
+    it, see write_cache.
+
+    Args:
+        (str) city - name of the city
+    """
+    if city in CACHE_LOCKS or fcntl is None:
+        yield
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(city_cache_dir(city) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        CACHE_LOCKS.add(city)
+        try:
+            yield
+        finally:
+            CACHE_LOCKS.discard(city)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def parse_timestamps(col, errors='raise'):
+
+    """
+    Parses fixed width "YYYY-MM-DD HH:MM:SS" timestamps and derives month, hour and weekday in the same pass.
+
+    The digits are read straight from the bytes of the strings, without format inference or per row Python
+    objects. Columns that do not match the layout (missing values, fractional seconds, ...) or hold impossible
+    dates or times (month 13, February 30, hour 25, ...) fall back to pd.to_datetime.
+
+    Args:
+        col - Pandas Series of timestamp strings
+        (str) errors - "raise" to fail on values pd.to_datetime cannot parse either, "coerce" to treat them as
+                       missing
+    Returns:
+        (ndarray) timestamps - datetime64[ns] per row, NaT for missing values
+        (ndarray) month - month number per row (january = 1), int8, MISSING_TIME for missing values
+        (ndarray) hour - hour per row, int8, MISSING_TIME for missing values
+        (ndarray) weekday - weekday number per row (monday = 0), int8, MISSING_TIME for missing values
+    """
+    try:
+        # one extra byte tells longer strings apart, shorter ones are padded with zero bytes
+        raw = np.asarray(col, dtype='S20').view(np.uint8).reshape(len(col), 20)
+    except (UnicodeEncodeError, ValueError, TypeError):
+        raw = None
+    digits = None
+    if raw is not None:
+        # non digits wrap around to values above 9 in uint8
+        digits = raw[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] - np.uint8(ord('0'))
+        layout_ok = ((raw[:, [4, 7]] == ord('-')).all() and (raw[:, 10] == ord(' ')).all() and
+                     (raw[:, [13, 16]] == ord(':')).all() and (raw[:, 19] == 0).all() and (digits <= 9).all())
+        if layout_ok:
+            fields = timestamp_fields(digits)
+        if not layout_ok or fields is None:
+            digits = None
+    if digits is None:
+        timestamps = pd.to_datetime(col, format=TIMESTAMP_FORMAT, errors='coerce')
+        if timestamps.isna().sum() > col.isna().sum():
+            # some values use another layout: let Pandas infer it per value
+            timestamps = pd.to_datetime(col, format='mixed', errors=errors)
+        timestamps = timestamps.astype('datetime64[ns]')
+        return (timestamps.to_numpy(), timestamps.dt.month.to_numpy(dtype=np.int8, na_value=MISSING_TIME),
+                timestamps.dt.hour.to_numpy(dtype=np.int8, na_value=MISSING_TIME),
+                timestamps.dt.weekday.to_numpy(dtype=np.int8, na_value=MISSING_TIME))
+
+    year, month, day, hour, minute, second = fields
+
+    # days since 1970-01-01 of the civil date (proleptic Gregorian calendar, years starting in March)
+    shifted = year - (month <= 2)
+    era = np.floor_divide(shifted, 400)
+    year_of_era = shifted - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era.astype(np.int64) * 146097 + day_of_era - 719468
+
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second
+    # 1970-01-01 was a Thursday (weekday 3)
+    weekday = (days + 3) % 7
+    return (seconds.astype('datetime64[s]').astype('datetime64[ns]'), month.astype(np.int8), hour.astype(np.int8),
+            weekday.astype(np.int8))
+
+
+def timestamp_fields(digits):
+
+    """
+    Combines the digits of fixed width timestamps into their fields and checks that every field is in range.
+
+    Args:
+        (ndarray) digits - rows x 14 digits of "YYYY-MM-DD HH:MM:SS", see parse_timestamps
+    Returns:
+        (tuple) fields - year, month, day, hour, minute and second arrays, or None if any value is out of range
+    """
+    digits = digits.astype(np.int32)
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month, 1, 12) - 1]
+    month_days += (month == 2) & leap
+    valid = ((month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days) & (hour < 24) & (minute < 60) &
+             (second < 60)).all()
+    return (year, month, day, hour, minute, second) if valid else None
+
+
+def prepare_city_data(df):
+
+    """
+    Adds the shared station dictionary and the derived time columns to freshly read csv data.
+
+    Args:
+        df - Pandas DataFrame as read from a city csv file (or a chunk of it)
+    Returns:
+        df - the same DataFrame with Start Time and End Time parsed and month, hour and day_of_week (weekday
+             number, monday = 0) columns added, End Time values that cannot be parsed are left missing
+    """
+    # one shared station dictionary per city, so start and end station codes are comparable
+    with span('stations.dictionary', rows=len(df)):
+        stations = df['Start Station'].cat.categories.union(df['End Station'].cat.categories)
+        df['Start Station'] = df['Start Station'].cat.set_categories(stations)
+        df['End Station'] = df['End Station'].cat.set_categories(stations)
+
+    # convert the Start Time column to datetime and extract month, hour and day of week in the same pass,
+    # the day of week is kept as a number and only turned into a name for display
+    with span('time.parse', rows=len(df)):
+        df['Start Time'], df['month'], df['hour'], df['day_of_week'] = parse_timestamps(df['Start Time'])
+    if 'End Time' in df:
+        with span('time.parse_end', rows=len(df)):
+            # only shown with the raw data, a bad value must not keep the city from loading
+            df['End Time'] = parse_timestamps(df['End Time'], errors='coerce')[0]
+    return df
+
+
+def parse_city_csv(city):
+
+    """
+    Parses the csv file of a city and adds the derived time columns.
+
+    Args:
+        (str) city - name of the city to parse
+    Returns:
+        df - Pandas DataFrame containing the full, unfiltered city data
+    """
+    # load data file into a data frame, text columns are dictionary encoded while parsing
+    with span('csv.read') as record:
+        df = pd.read_csv(CITY_DATA[city], dtype=CSV_DTYPES)
+        record['rows'] = len(df)
+    return prepare_city_data(df)
+
+
+def needs_streaming(city):
+    """Returns whether the csv file of a city is larger than STREAM_THRESHOLD_BYTES, too large to load at once."""
+    return os.path.getsize(CITY_DATA[city]) > STREAM_THRESHOLD_BYTES
+
+
+def iter_city_chunks(city, month='all', day='all', chunksize=STREAM_CHUNKSIZE):
+
+    """
+    Streams the csv file of a city in chunks of bounded size and filters each chunk by month and day.
+
+    Args:
+        (str) city - name of the city to stream
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - number of csv rows read per chunk
+    Returns:
+        generator of Pandas DataFrames containing the matching rows of each chunk, indexed by csv row number
+    """
+    with pd.read_csv(CITY_DATA[city], dtype=CSV_DTYPES, chunksize=chunksize) as reader:
+        while True:
+            with span('csv.read_chunk') as record:
+                chunk = next(reader, None)
+                record['rows'] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                return
+            yield filter_data(prepare_city_data(chunk), month, day)
+
+
+def filter_data(df, month, day):
+
+    """
+    Filters city data by month and day if applicable.
+
+    Args:
+        df - Pandas DataFrame containing city data
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        df - Pandas DataFrame containing city data filtered by month and day
+    """
+    with span('filter', rows=len(df)):
+        # filter by month if applicable
+        if month != 'all':
+            # use the index of the months list to get the corresponding int
+            months = ['january', 'february', 'march', 'april', 'may', 'june']
+            month = months.index(month) + 1
+
+            # filter by month to create the new dataframe
+            df = df[df['month'] == month]
+
+        # filter by day of week if applicable, rows without a start time (MISSING_TIME) match neither filter
+        if day != 'all':
+            # filter by day of week (monday = 0) to create the new dataframe
+            df = df[df['day_of_week'] == WEEKDAY_DATA.index(day)]
+    return df
+
+
+def build_cache(city):
+
+    """
+    Parses the csv file of a city and stores every column in the columnar cache.
+
+    Rows are stored grouped by (month, weekday) partition, each partition in csv order, so a month/day filter
+    maps to a few contiguous row ranges. Numeric and datetime columns are stored as they are, text columns as
+    integer codes plus a fixed width array of the distinct values (or as fixed width strings if nearly every
+    value is distinct), so every file can be memory mapped and sliced on the next load.
+
+    Args:
+        (str) city - name of the city to cache
+    Returns:
+        df - Pandas DataFrame containing the full, unfiltered city data
+        (dict) meta - metadata of the new cache build, see read_cache_meta
+    """
+    fingerprint = source_fingerprint(city)
+    df = parse_city_csv(city)
+    with span('cache.write', rows=len(df)):
+        meta = write_cache(city, fingerprint, df)
+    return df, meta
+
+
+def write_cache(city, fingerprint, df):
+
+    """
+    Writes parsed city data to the columnar cache, see build_cache.
+
+    Args:
+        (str) city - name of the city
+        (dict) fingerprint - fingerprint of the csv file the data was parsed from
+        df - Pandas DataFrame containing the full, unfiltered city data
+    Returns:
+        (dict) meta - metadata of the new cache build
+    """
+    # order rows by partition key, the stable sort keeps csv order within each partition; rows without a start
+    # time (month and weekday MISSING_TIME) get a partition of their own, only read by unfiltered queries
+    months = df['month'].to_numpy()
+    weekdays = df['day_of_week'].to_numpy()
+    keys = months.astype(np.int64) * 7 + weekdays
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], bounds)) if len(keys) else np.array([], dtype=np.int64)
+    stops = np.concatenate((bounds, [len(keys)])) if len(keys) else np.array([], dtype=np.int64)
+    partitions = [[int(months[order[start]]), int(weekdays[order[start]]), int(start), int(stop)]
+                  for start, stop in zip(starts, stops)]
+
+    # every build gets a directory of its own, written to a temporary name first so a crash never leaves a half
+    # written build behind; readers map the files of the build their metadata names, so a rebuild never swaps
+    # files under a reader
+    target = city_cache_dir(city)
+    build = 'build-{}-{}'.format(time.time_ns(), os.getpid())
+    tmp = os.path.join(target, build + '.tmp')
+    os.makedirs(tmp)
+
+    # the original row number of every cached row, used as index and to restore csv order across partitions
+    np.save(os.path.join(tmp, 'index.npy'), df.index.to_numpy()[order].astype(np.int64))
+    # and the other way round, the cache position of every csv row, used to browse rows in csv order lazily
+    positions = np.empty(len(order), dtype=np.int64)
+    positions[order] = np.arange(len(order))
+    np.save(os.path.join(tmp, 'positions.npy'), positions)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        entry = {'name': name, 'file': '{}.npy'.format(i), 'dtype': str(col.dtype)}
+        if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_datetime64_any_dtype(col):
+            entry['kind'] = 'values'
+            np.save(os.path.join(tmp, entry['file']), col.to_numpy()[order])
+            columns.append(entry)
+            continue
+
+        # dictionary encode text columns, missing values get the code -1
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+        else:
+            codes, uniques = pd.factorize(col)
+        if len(uniques) > len(col) // 2 and (codes >= 0).all():
+            # (nearly) unique values like End Time: a dictionary would be as large as the column itself
+            entry['kind'] = 'strings'
+            np.save(os.path.join(tmp, entry['file']), np.asarray(col, dtype=str)[order])
+            columns.append(entry)
+            continue
+
+        entry['kind'] = 'text'
+        np.save(os.path.join(tmp, entry['file']), codes[order])
+        # columns sharing a dictionary (start and end station) share its file
+        shared = [prev for prev in columns if prev['kind'] == 'text' and prev['dtype'] == 'category' and
+                  entry['dtype'] == 'category' and col.cat.categories.equals(df[prev['name']].cat.categories)]
+        if shared:
+            entry['values_file'] = shared[0]['values_file']
+        else:
+            entry['values_file'] = '{}.values.npy'.format(i)
+            np.save(os.path.join(tmp, entry['values_file']), np.asarray(uniques, dtype=str))
+        columns.append(entry)
+
+    os.replace(tmp, os.path.join(target, build))
+
+    # then point the metadata to the new build in one atomic step
+    meta = {'version': CACHE_VERSION, 'source': fingerprint, 'rows': len(df), 'columns': columns,
+            'partitions': partitions, 'build': build}
+    meta_path = os.path.join(target, 'meta.json')
+    try:
+        with open(meta_path) as f:
+            previous = json.load(f).get('build')
+    except (OSError, ValueError, AttributeError):
+        previous = None
+    meta_tmp = os.path.join(target, 'meta.tmp{}.json'.format(os.getpid()))
+    with open(meta_tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_tmp, meta_path)
+
+    # the build just replaced stays for readers still busy with it, older builds and leftovers of crashed
+    # writers (or of older cache layouts) go
+    for name in os.listdir(target):
+        if name in ('meta.json', 'cube.npz', build, previous):
+            continue
+        path = os.path.join(target, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+    return meta
+
+
+def filter_keys(month, day):
+
+    """
+    Translates a month and day filter into the numbers used as partition keys.
+
+    Args:
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        (int) month_no - month number (january = 1), None for "all"
+        (int) weekday_no - weekday number (monday = 0), None for "all"
+    """
+    month_no = None if month == 'all' else MONTH_DATA.index(month) + 1
+    weekday_no = None if day == 'all' else WEEKDAY_DATA.index(day)
+    return month_no, weekday_no
+
+
+def select_partitions(meta, month, day):
+
+    """
+    Looks up the cached row ranges matching a month and day filter.
+
+    Args:
+        (dict) meta - cache metadata as returned by read_cache_meta
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        (list) ranges - (start, stop) row ranges of the matching partitions in cache order
+    """
+    month_no, weekday_no = filter_keys(month, day)
+    return [(start, stop) for p_month, p_weekday, start, stop in meta['partitions']
+            if month_no in (None, p_month) and weekday_no in (None, p_weekday)]
+
+
+def read_cache_meta(city):
+
+    """
+    Reads the metadata of the cached city data.
+
+    Args:
+        (str) city - name of the city
+    Returns:
+        (dict) meta - cache metadata, or None if there is no cache or it does not match the current csv file
+    """
+    try:
+        with open(os.path.join(city_cache_dir(city), 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION or meta.get('source') != source_fingerprint(city):
+        return None
+    return meta
+
+
+def read_city(city, month='all', day='all'):
+
+    """
+    Loads the data of a city, from the columnar cache if it is up to date, otherwise from the csv file.
+
+    Only the cached partitions matching the month and day filter are read, so load time and memory scale with
+    the selected slice rather than with the whole file.
+
+    Args:
+        (str) city - name of the city to load
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        df - Pandas DataFrame containing city data filtered by month and day, indexed by csv row number
+    """
+    meta = read_cache_meta(city)
+    if meta is None:
+        with cache_lock(city):
+            # no cache yet or the csv file changed: parse the csv once, (re)build the cache and filter in memory,
+            # unless another process did so while this one waited for the lock
+            meta = read_cache_meta(city)
+            if meta is None:
+                return filter_data(build_cache(city)[0], month, day)
+
+    return read_ranges(city, meta, select_partitions(meta, month, day))
+
+
+def read_ranges(city, meta, ranges, columns=None):
+
+    """
+    Reads row ranges of the columnar cache of a city.
+
+    Args:
+        (str) city - name of the city
+        (dict) meta - cache metadata as returned by read_cache_meta
+        (list) ranges - (start, stop) row ranges in cache order
+        (list) columns - names of the columns to read, None to read all columns
+    Returns:
+        df - Pandas DataFrame containing the selected rows in csv order, indexed by csv row number
+    """
+    cache_dir = cache_build_dir(city, meta)
+
+    def read_slices(values):
+        # copy only the selected row ranges out of the mapped file
+        if not ranges:
+            return np.asarray(values[:0])
+        return np.concatenate([values[start:stop] for start, stop in ranges])
+
+    with span('cache.read', rows=sum(stop - start for start, stop in ranges)):
+        # restore csv order if rows come from more than one partition
+        order = slice(None)
+        if len(ranges) > 1:
+            order = np.argsort(read_slices(np.load(os.path.join(cache_dir, 'index.npy'), mmap_mode='r')),
+                               kind='stable')
+        return read_cached_columns(cache_dir, meta, lambda values: read_slices(values)[order], columns)
+
+
+def read_positions(city, meta, positions, columns=None):
+
+    """
+    Reads single rows of the columnar cache of a city.
+
+    Args:
+        (str) city - name of the city
+        (dict) meta - cache metadata as returned by read_cache_meta
+        (ndarray) positions - cache positions of the rows to read, in the order they are returned
+        (list) columns - names of the columns to read, None to read all columns
+    Returns:
+        df - Pandas DataFrame containing the selected rows, indexed by csv row number
+    """
+    with span('cache.read_rows', rows=len(positions)):
+        return read_cached_columns(cache_build_dir(city, meta), meta, lambda values: values[positions], columns)
+
+
+def read_cached_columns(cache_dir, meta, select, columns):
+    """Maps the cached column files and builds a DataFrame of the rows select picks out of each of them."""
+    def read(file_name):
+        return select(np.load(os.path.join(cache_dir, file_name), mmap_mode='r'))
+
+    index = read('index.npy')
+    data = {}
+    dictionaries = {}
+    for entry in meta['columns']:
+        if columns is not None and entry['name'] not in columns:
+            continue
+        values = read(entry['file'])
+        if entry['kind'] == 'text':
+            # keep dictionary encoded columns as categoricals, they share one dictionary array per file
+            if entry['values_file'] not in dictionaries:
+                uniques = np.load(os.path.join(cache_dir, entry['values_file'])).astype(object)
+                dictionaries[entry['values_file']] = pd.CategoricalDtype(uniques)
+            values = pd.Categorical.from_codes(values, dtype=dictionaries[entry['values_file']])
+            if entry['dtype'] != 'category':
+                values = values.astype(entry['dtype'])
+        elif entry['kind'] == 'strings':
+            values = pd.Series(values.astype(object)).astype(entry['dtype']).to_numpy()
+        data[entry['name']] = values
+    return pd.DataFrame(data, index=pd.Index(index))
+
+
+def iter_positions(city, meta, ranges, block=65536):
+
+    """
+    Lazily finds the cache positions of the rows in the given ranges, in csv order.
+
+    A single range is already in csv order. Otherwise the csv to cache position map is scanned block by block
+    and only positions inside the ranges are kept, so the first matches are found without reading the rest.
+
+    Args:
+        (str) city - name of the city
+        (dict) meta - cache metadata as returned by read_cache_meta
+        (list) ranges - (start, stop) row ranges in cache order, as returned by select_partitions
+        (int) block - number of positions scanned at once
+    Returns:
+        generator of ndarrays of cache positions
+    """
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        for first in range(start, stop, block):
+            yield np.arange(first, min(first + block, stop))
+        return
+    if not ranges:
+        return
+
+    positions = np.load(os.path.join(cache_build_dir(city, meta), 'positions.npy'), mmap_mode='r')
+    starts = np.array([start for start, _ in ranges])
+    stops = np.array([stop for _, stop in ranges])
+    for first in range(0, len(positions), block):
+        chunk = np.asarray(positions[first:first + block])
+        # the ranges are sorted and disjoint: find the range a position could fall in and check its end
+        slot = np.searchsorted(starts, chunk, side='right') - 1
+        matches = chunk[(slot >= 0) & (chunk < stops[np.maximum(slot, 0)])]
+        if len(matches):
+            yield matches
+
+
+def iter_row_pages(city, month='all', day='all', page_size=5, first_page=0):
+
+    """
+    Browses the raw rows of a city matching a month and day filter page by page, in csv order.
+
+    Rows are read from the memory mapped cache only when their page is asked for, so the first page is shown
+    without loading the city data, and any page can be the first one.
+
+    Args:
+        (str) city - name of the city
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) page_size - number of rows per page
+        (int) first_page - number of the page to start at, 0 for the first page
+    Returns:
+        generator of Pandas DataFrames with page_size rows each (the last page may be shorter)
+    """
+    meta = ensure_cache(city)
+    skip = first_page * page_size
+    pending = np.array([], dtype=np.int64)
+    for positions in iter_positions(city, meta, select_partitions(meta, month, day)):
+        # skip the rows of the pages before the first one without reading them
+        if skip:
+            skipped = min(skip, len(positions))
+            positions = positions[skipped:]
+            skip -= skipped
+        pending = np.concatenate([pending, positions])
+        while len(pending) >= page_size:
+            yield read_positions(city, meta, pending[:page_size])
+            pending = pending[page_size:]
+    if len(pending):
+        yield read_positions(city, meta, pending)
+
+
+def read_page(city, month='all', day='all', page=0, page_size=5):
+
+    """
+    Reads one page of the raw rows of a city matching a month and day filter.
+
+    Args:
+        (str) city - name of the city
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) page - number of the page, 0 for the first page
+        (int) page_size - number of rows per page
+    Returns:
+        df - Pandas DataFrame containing the rows of the page, empty past the last page
+    """
+    pages = iter_row_pages(city, month, day, page_size, page)
+    page_rows = next(pages, None)
+    pages.close()
+    if page_rows is None:
+        return read_positions(city, ensure_cache(city), np.array([], dtype=np.int64))
+    return page_rows
+
+
+def load_data(city, month, day):
+
+    """
+    Loads data for the specified city and filters by month and day if applicable.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        df - Pandas DataFrame containing city data filtered by month and day
+    """
+    # load the matching city data only, served from the partitioned columnar cache unless the csv file changed
+    return read_city(city, month, day)
+
+
+def iter_pages(frames, size=5):
+
+    """
+    Regroups a stream of DataFrames into pages of a fixed number of rows.
+
+    Args:
+        frames - iterable of Pandas DataFrames, e.g. a whole DataFrame in a list or streamed chunks
+        (int) size - number of rows per page
+    Returns:
+        generator of Pandas DataFrames with size rows each (the last page may be shorter)
+    """
+    buffer = []
+    buffered = 0
+    for frame in frames:
+        buffer.append(frame)
+        buffered += len(frame)
+        while buffered >= size:
+            rows = pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+            yield rows.iloc[:size]
+            rest = rows.iloc[size:]
+            buffer = [rest]
+            buffered = len(rest)
+    if buffered:
+        yield pd.concat(buffer) if len(buffer) > 1 else buffer[0]
+
+
+def display_raw_data(pages):
+
+    """
+    Shows pages of raw data rows as long as the user asks for more.
+
+    Args:
+        pages - iterator of Pandas DataFrames, one page of rows each
+    """
+    show5 = input("Would you like to see five rows of the raw data?").lower()
+    # make sure only predefined input is chosen
+    while not(show5.lower() in SHOW_ROWS):
+        show5 = input("Input is neither yes nor no, please choose one of those options.").lower()
+    while show5.lower() == 'yes':
+        # print "next" five rows, pages are only read when they are asked for
+        page = next(pages, None)
+        if page is None:
+            print('There are no more rows to show.')
+            break
+        # weekdays are stored as numbers (monday = 0), show their names
+        if 'day_of_week' in page and pd.api.types.is_integer_dtype(page['day_of_week']):
+            page = page.assign(day_of_week=[calendar.day_name[day] if day != MISSING_TIME else None
+                                            for day in page['day_of_week']])
+        # rows without a start time have no month and hour either
+        page = page.assign(**{name: page[name].where(page[name] != MISSING_TIME) for name in ('month', 'hour')
+                              if name in page})
+        print(page)
+        show5 = input("Would you like to see another 5 rows of data?").lower()
+        while not(show5.lower() in SHOW_ROWS):
+            show5 = input("Input is neither yes nor no, please choose one of those options.").lower()
+
+
+def encode(col):
+
+    """
+    Dictionary encodes a column.
+
+    Args:
+        col - Pandas Series to encode
+    Returns:
+        (ndarray) codes - integer code per row, -1 for missing values
+        labels - Pandas Index of the distinct values, codes point into it
+    """
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # categorical columns already carry their codes
+        return col.cat.codes.to_numpy(), col.cat.categories
+    codes, labels = pd.factorize(col, sort=True)
+    return codes, pd.Index(labels)
+
+
+def count_codes(codes, labels, name):
+
+    """
+    Counts integer codes into a value count table.
+
+    Args:
+        (ndarray) codes - integer code per row, -1 for missing values
+        labels - Pandas Index the codes point into
+        (str) name - name of the counted column
+    Returns:
+        counts - Pandas Series of counts indexed by value, values that do not occur are left out
+    """
+    counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+    present = np.flatnonzero(counts)
+    return pd.Series(counts[present], index=labels[present].rename(name), dtype=np.int64)
+
+
+def count_numbers(col, missing=None):
+
+    """
+    Counts the values of a numeric column, ignoring missing values.
+
+    Args:
+        col - Pandas Series of numbers
+        (int) missing - value standing for missing values in columns that cannot hold NaN, e.g. MISSING_TIME
+    Returns:
+        counts - Pandas Series of counts indexed by value
+    """
+    values = col.to_numpy(dtype=np.float64, na_value=np.nan)
+    values = values[~np.isnan(values)]
+    if missing is not None:
+        values = values[values != missing]
+    if not len(values):
+        # nothing to count (e.g. a chunk filtered empty): keep the label dtype so merging does not turn it to float
+        dtype = col.dtype if pd.api.types.is_integer_dtype(col) else np.float64
+        return pd.Series([], index=pd.Index(np.array([], dtype=dtype), name=col.name), dtype=np.int64)
+    if (values == np.floor(values)).all():
+        # whole numbers (months, hours, years): count with an offset bincount instead of sorting
+        offset = int(values.min())
+        counts = np.bincount((values - offset).astype(np.int64))
+        present = np.flatnonzero(counts)
+        labels = (present + offset).astype(col.dtype if pd.api.types.is_integer_dtype(col) else np.float64)
+        return pd.Series(counts[present], index=pd.Index(labels, name=col.name), dtype=np.int64)
+    labels, counts = np.unique(values, return_counts=True)
+    return pd.Series(counts, index=pd.Index(labels, name=col.name), dtype=np.int64)
+
+
+def aggregate(df):
+
+    """
+    Computes the mergeable count tables and sums behind all reported statistics in one pass over the data.
+
+    Args:
+        df - Pandas DataFrame containing (filtered) city data
+    Returns:
+        (dict) agg - value counts per reported column, station pair counts and trip duration sum and count,
+                     Gender and Birth Year counts are None if the city has no such data
+    """
+    agg = {'rows': len(df)}
+    timings = agg['timings'] = {}
+
+    def metric(key, fn, *args):
+        # compute one metric inside its own span and keep its duration for the display functions
+        with span('metric.' + key, rows=len(df)) as record:
+            result = fn(*args)
+        timings[key] = record['seconds']
+        return result
+
+    # time of travel
+    agg['month'] = metric('month', count_numbers, df['month'], MISSING_TIME)
+    agg['hour'] = metric('hour', count_numbers, df['hour'], MISSING_TIME)
+    agg['day_of_week'] = metric('day_of_week', count_numbers, df['day_of_week'], MISSING_TIME)
+
+    # stations: one shared dictionary for start and end stations so a pair maps to a single integer
+    start_codes, end_codes, labels = metric('stations', station_codes, df['Start Station'], df['End Station'])
+    agg['start_station'] = metric('start_station', count_codes, start_codes, labels, 'Start Station')
+    agg['end_station'] = metric('end_station', count_codes, end_codes, labels, 'End Station')
+    agg['trip'] = metric('trip', count_pairs, start_codes, end_codes, labels)
+
+    # trip duration
+    duration_sum, duration_count = metric('duration', sum_durations, df['Trip Duration'])
+    agg['duration_sum'] = duration_sum
+    agg['duration_count'] = duration_count
+
+    # users
+    agg['user_type'] = metric('user_type', lambda: count_codes(*encode(df['User Type']), 'User Type'))
+    agg['gender'] = None
+    agg['birth_year'] = None
+    if 'Gender' in df:
+        agg['gender'] = metric('gender', lambda: count_codes(*encode(df['Gender']), 'Gender'))
+    if 'Birth Year' in df:
+        agg['birth_year'] = metric('birth_year', count_numbers, df['Birth Year'])
+    return agg
+
+
+def station_codes(start, end):
+
+    """
+    Encodes start and end stations with one shared dictionary.
+
+    Args:
+        start - Pandas Series of start stations
+        end - Pandas Series of end stations
+    Returns:
+        (ndarray) start_codes - integer code per start station, -1 for missing values
+        (ndarray) end_codes - integer code per end station, -1 for missing values
+        labels - Pandas Index of all stations, both codes point into it
+    """
+    if isinstance(start.dtype, pd.CategoricalDtype) and start.dtype == end.dtype:
+        start_codes, labels = encode(start)
+        end_codes, _ = encode(end)
+        return start_codes, end_codes, labels
+
+    # encode both columns on their own, then map their codes onto the union of both dictionaries
+    start_codes, start_labels = encode(start)
+    end_codes, end_labels = encode(end)
+    labels = start_labels.union(end_labels)
+    start_codes = np.where(start_codes >= 0, labels.get_indexer(start_labels)[start_codes], -1)
+    end_codes = np.where(end_codes >= 0, labels.get_indexer(end_labels)[end_codes], -1)
+    return start_codes, end_codes, labels
+
+
+def count_pairs(start_codes, end_codes, labels):
+
+    """
+    Counts start and end station pairs.
+
+    Args:
+        (ndarray) start_codes - integer code per start station, -1 for missing values
+        (ndarray) end_codes - integer code per end station, -1 for missing values
+        labels - Pandas Index of all stations, both codes point into it
+    Returns:
+        counts - Pandas Series of counts indexed by (Start Station, End Station)
+    """
+    # combine both codes into one integer, bincount while the pair space stays small
+    valid = (start_codes >= 0) & (end_codes >= 0)
+    pair_codes = start_codes[valid].astype(np.int64) * len(labels) + end_codes[valid]
+    if len(labels) ** 2 <= 1 << 24:
+        counts = np.bincount(pair_codes, minlength=len(labels) ** 2)
+        pairs = np.flatnonzero(counts)
+        counts = counts[pairs]
+    else:
+        pairs, counts = np.unique(pair_codes, return_counts=True)
+    pair_index = pd.MultiIndex(levels=[labels, labels], codes=[pairs // len(labels), pairs % len(labels)],
+                               names=['Start Station', 'End Station'])
+    return pd.Series(counts, index=pair_index, dtype=np.int64)
+
+
+def sum_durations(col):
+    """Returns the sum and the number of the trip durations, ignoring missing values."""
+    duration = col.to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = ~np.isnan(duration)
+    return float(duration[valid].sum()), int(valid.sum())
+
+
+def merge_aggregates(aggs):
+
+    """
+    Merges partial aggregates, e.g. of several partitions or chunks, into one.
+
+    Args:
+        (list) aggs - partial aggregates as returned by aggregate
+    Returns:
+        (dict) agg - the combined aggregate, equal to aggregating all underlying rows at once
+    """
+    merged = {'rows': sum(agg['rows'] for agg in aggs),
+              'duration_sum': sum(agg['duration_sum'] for agg in aggs),
+              'duration_count': sum(agg['duration_count'] for agg in aggs)}
+    # the time of a metric is the time spent on it in every part plus the time merging it
+    timings = merged['timings'] = {}
+    for agg in aggs:
+        for key, seconds in agg.get('timings', {}).items():
+            timings[key] = timings.get(key, 0.0) + seconds
+    for key in ('month', 'hour', 'day_of_week', 'start_station', 'end_station', 'trip', 'user_type', 'gender',
+                'birth_year'):
+        tables = [agg[key] for agg in aggs if agg[key] is not None]
+        if not tables:
+            merged[key] = None
+            continue
+        with span('merge.' + key, rows=sum(len(table) for table in tables)) as record:
+            table = pd.concat(tables)
+            merged[key] = table.groupby(level=list(range(table.index.nlevels))).sum().astype(np.int64)
+        timings[key] = timings.get(key, 0.0) + record['seconds']
+    return merged
+
+
+def mode(counts):
+
+    """
+    Returns the most frequent value of a count table, the smallest value on ties like Pandas mode()[0].
+
+    Args:
+        counts - Pandas Series of counts indexed by value
+    Returns:
+        the most frequent value, or None if the table is empty
+    """
+    if counts is None or not len(counts):
+        return None
+    return counts.index[counts.to_numpy() == counts.max()].min()
+
+
+def weekday_names(counts):
+    """Returns a weekday count table indexed by weekday name instead of number (monday = 0)."""
+    if counts is None:
+        return None
+    return pd.Series(counts.to_numpy(), index=pd.Index([calendar.day_name[int(day)] for day in counts.index],
+                                                       name=counts.index.name))
+
+
+def summarize(agg):
+
+    """
+    Turns an aggregate into the statistics reported by the display functions.
+
+    Args:
+        (dict) agg - aggregate as returned by aggregate or merge_aggregates
+    Returns:
+        (dict) stats - most frequent times, stations and trip, total and average trip duration in seconds,
+                       user type and gender counts and youngest, oldest and most frequent year of birth
+    """
+    with span('summarize', rows=agg['rows']):
+        return summarize_aggregate(agg)
+
+
+def summarize_aggregate(agg):
+    """Derives the statistics from an aggregate, see summarize."""
+    stats = {'rows': agg['rows'],
+             'timings': dict(agg.get('timings', {})),
+             'popular_month': mode(agg['month']),
+             'popular_day': mode(weekday_names(agg['day_of_week'])),
+             'popular_hour': mode(agg['hour']),
+             'popular_start': mode(agg['start_station']),
+             'popular_end': mode(agg['end_station']),
+             'popular_trip': mode(agg['trip']),
+             'travel_total': agg['duration_sum'],
+             'travel_mean': agg['duration_sum'] / agg['duration_count'] if agg['duration_count'] else None,
+             'user_types': agg['user_type'].sort_index(),
+             'genders': agg['gender'].sort_index() if agg['gender'] is not None else None,
+             'youngest_yob': None, 'oldest_yob': None, 'most_yob': None}
+    if agg['birth_year'] is not None and len(agg['birth_year']):
+        stats['youngest_yob'] = int(agg['birth_year'].index.max())
+        stats['oldest_yob'] = int(agg['birth_year'].index.min())
+        stats['most_yob'] = int(mode(agg['birth_year']))
+    return stats
+
+
+def compute_stats(df):
+    """Computes all reported statistics of the (filtered) city data in one pass."""
+    with span('compute_stats', rows=len(df)):
+        return summarize(aggregate(df))
+
+
+def stream_stats(city, month, day, chunksize=STREAM_CHUNKSIZE):
+
+    """
+    Computes all reported statistics of a city without loading the whole csv file into memory.
+
+    Every chunk is filtered and aggregated on its own and merged into a running aggregate, so peak memory is
+    bounded by the chunk size (plus the count tables) and the result equals the in-memory computation.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - number of csv rows read per chunk
+    Returns:
+        (dict) stats - statistics as returned by summarize
+    """
+    return summarize(stream_aggregate(city, month, day, chunksize))
+
+
+def stream_aggregate(city, month, day, chunksize=STREAM_CHUNKSIZE):
+    """Aggregates the csv file of a city chunk by chunk, see stream_stats."""
+    return stream_aggregates(city, [(month, day)], chunksize)[0]
+
+
+def stream_aggregates(city, filters, chunksize=STREAM_CHUNKSIZE):
+
+    """
+    Aggregates several month and day filters of a city in one pass over its csv file, see stream_stats.
+
+    Args:
+        (str) city - name of the city to analyze
+        (list) filters - (month, day) tuples
+        (int) chunksize - number of csv rows read per chunk
+    Returns:
+        (list) aggs - aggregate per filter, in filter order
+    """
+    aggs = [None] * len(filters)
+    with span('stream_stats'):
+        for chunk in iter_city_chunks(city, chunksize=chunksize):
+            for i, (month, day) in enumerate(filters):
+                part = filter_data(chunk, month, day)
+                # chunks without matching rows add nothing (sorted files have many of them)
+                if aggs[i] is not None and not len(part):
+                    continue
+                part_agg = aggregate(part)
+                aggs[i] = part_agg if aggs[i] is None else merge_aggregates([aggs[i], part_agg])
+    return aggs
+
+
+def ensure_cache(city):
+
+    """
+    Makes sure the columnar cache of a city is up to date.
+
+    Args:
+        (str) city - name of the city
+    Returns:
+        (dict) meta - cache metadata as returned by read_cache_meta
+    """
+    meta = read_cache_meta(city)
+    if meta is None:
+        with cache_lock(city):
+            # another process may have rebuilt the cache while this one waited for the lock
+            meta = read_cache_meta(city)
+            if meta is None:
+                # the metadata of the build just written, even if the csv file changed again meanwhile
+                _, meta = build_cache(city)
+    return meta
+
+
+def split_ranges(ranges, parts):
+
+    """
+    Splits row ranges into groups of about the same number of rows.
+
+    Args:
+        (list) ranges - (start, stop) row ranges
+        (int) parts - number of groups to create
+    Returns:
+        (list) groups - lists of (start, stop) row ranges, at most parts of them
+    """
+    total = sum(stop - start for start, stop in ranges)
+    size = max(1, -(-total // max(1, parts)))
+    groups = []
+    group = []
+    filled = 0
+    for start, stop in ranges:
+        # cut ranges at group boundaries so a single large partition is spread over several groups as well
+        while start < stop:
+            take = min(stop - start, size - filled)
+            group.append((start, start + take))
+            filled += take
+            start += take
+            if filled == size:
+                groups.append(group)
+                group = []
+                filled = 0
+    if group:
+        groups.append(group)
+    return groups
+
+
+def aggregate_ranges(city, meta, ranges):
+    """Aggregates row ranges of the columnar cache of a city, runs in the worker processes."""
+    return aggregate(read_ranges(city, meta, ranges, columns=STATS_COLUMNS))
+
+
+def parallel_stats(city, month, day, workers=None, executor=None):
+
+    """
+    Computes all reported statistics of a city on several processes.
+
+    The rows matching the filter are split into row ranges of about equal size, one per worker, every worker
+    aggregates its ranges straight from the memory mapped cache and the partial aggregates are merged.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) workers - number of worker processes, defaults to the number of cpus
+        executor - optional running concurrent.futures executor to submit the work to
+    Returns:
+        (dict) stats - statistics as returned by summarize
+    """
+    return summarize(parallel_aggregate(city, month, day, workers, executor))
+
+
+def parallel_aggregate(city, month, day, workers=None, executor=None):
+    """Aggregates the matching rows of a city on several processes, see parallel_stats."""
+    return parallel_aggregates([(city, month, day)], workers, executor)[0]
+
+
+def parallel_aggregates(queries, workers=None, executor=None):
+
+    """
+    Aggregates several queries, e.g. of different cities, at the same time on one pool of processes.
+
+    The rows of every query are split into one group of row ranges per worker and all groups of all queries are
+    submitted at once, so the workers stay busy until the last query is done.
+
+    Args:
+        (list) queries - (city, month, day) tuples
+        (int) workers - number of worker processes, defaults to the number of cpus
+        executor - optional running concurrent.futures executor to submit the work to
+    Returns:
+        (list) aggs - aggregate per query, in query order
+    """
+    workers = workers or os.cpu_count() or 1
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return parallel_aggregates(queries, workers, pool)
+
+    with span('parallel_stats'):
+        # build missing caches side by side, then spread the rows of every query over all workers
+        cities = list(dict.fromkeys(city for city, _, _ in queries))
+        metas = dict(zip(cities, executor.map(ensure_cache, cities)))
+        futures = []
+        for city, month, day in queries:
+            groups = split_ranges(select_partitions(metas[city], month, day), workers) or [[]]
+            futures.append([executor.submit(aggregate_ranges, city, metas[city], group) for group in groups])
+        return [merge_aggregates([future.result() for future in query_futures]) for query_futures in futures]
+
+
+def parallel_city_stats(month, day, cities=None, workers=None):
+
+    """
+    Computes all reported statistics of several cities at the same time on one pool of processes.
+
+    Args:
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (list) cities - names of the cities to analyze, defaults to all cities
+        (int) workers - number of worker processes, defaults to the number of cpus
+    Returns:
+        (dict) stats - statistics as returned by summarize, per city
+    """
+    cities = list(CITY_DATA) if cities is None else cities
+    aggs = parallel_aggregates([(city, month, day) for city in cities], workers)
+    return {city: summarize(agg) for city, agg in zip(cities, aggs)}
+
+
+def build_cube(city, workers=None):
+
+    """
+    Precomputes the aggregate of every (month, weekday) cell of a city and stores them as the rollup cube.
+
+    Every count table is stored as a dense cells x values matrix over the values occurring in the whole city,
+    station pairs as a sparse (cell, pair, count) list. Any month/day query is a merge of some cells.
+
+    Args:
+        (str) city - name of the city
+        (int) workers - number of worker processes aggregating the cells, defaults to the number of cpus
+    Returns:
+        (dict) cube - the cube as returned by load_cube
+    """
+    with cache_lock(city):
+        with span('cube.build'):
+            write_cube(city, workers)
+        return load_cube(city)
+
+
+def label_arrays(arrays, key, labels):
+
+    """
+    Adds the labels of a count table to arrays that can be stored without pickle.
+
+    Text labels are stored as fixed width strings, station pairs as one array of start and one of end stations.
+
+    Args:
+        (dict) arrays - arrays by name to add the labels to, as <key>_labels or <key>_start and <key>_end
+        (str) key - name of the count table
+        labels - Pandas Index (or MultiIndex of station pairs) of the count table
+    """
+    if isinstance(labels, pd.MultiIndex):
+        arrays[key + '_start'] = labels.get_level_values(0).to_numpy(dtype=str)
+        arrays[key + '_end'] = labels.get_level_values(1).to_numpy(dtype=str)
+        return
+    if not pd.api.types.is_numeric_dtype(labels):
+        labels = labels.astype(object)
+    arrays[key + '_labels'] = labels.to_numpy(dtype=str if labels.dtype == object else None)
+
+
+def labels_from_arrays(arrays, key):
+    """Removes the labels stored by label_arrays from arrays and returns them as Pandas Index (or MultiIndex)."""
+    if key + '_start' in arrays:
+        return pd.MultiIndex.from_arrays([arrays.pop(key + '_start').astype(object),
+                                          arrays.pop(key + '_end').astype(object)],
+                                         names=['Start Station', 'End Station'])
+    labels = arrays.pop(key + '_labels')
+    return pd.Index(labels.astype(object) if labels.dtype.kind == 'U' else labels, name=CUBE_TABLES[key])
+
+
+def write_cube(city, workers=None):
+    """Aggregates the cells of a city and writes them to the cube file, see build_cube."""
+    meta = ensure_cache(city)
+    fingerprint = meta['source']
+    workers = workers or os.cpu_count() or 1
+
+    # every cached partition is one cell, aggregate them side by side if there is more than one cpu
+    cells = [(p_month, p_weekday) for p_month, p_weekday, _, _ in meta['partitions']]
+    groups = [[(start, stop)] for _, _, start, stop in meta['partitions']]
+    if workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            cell_aggs = list(pool.map(aggregate_ranges, [city] * len(groups), [meta] * len(groups), groups))
+    else:
+        cell_aggs = [aggregate_ranges(city, meta, group) for group in groups]
+
+    # the aggregate of the whole city defines the value axis of every table
+    total = merge_aggregates(cell_aggs) if cell_aggs else aggregate(read_ranges(city, meta, [], STATS_COLUMNS))
+    arrays = {}
+    arrays['cells'] = np.array(cells, dtype=np.int16).reshape(-1, 2)
+    for key in ('rows', 'duration_sum', 'duration_count'):
+        arrays[key] = np.array([agg[key] for agg in cell_aggs])
+
+    for key in CUBE_TABLES:
+        if total[key] is None:
+            continue
+        labels = total[key].index
+        label_arrays(arrays, key, labels)
+        arrays[key + '_counts'] = np.array([agg[key].reindex(labels, fill_value=0).to_numpy() for agg in cell_aggs],
+                                           dtype=np.int64).reshape(len(cells), len(labels))
+
+    # station pairs: position of each cell's pair in the pair list of the whole city
+    pairs = total['trip'].index
+    label_arrays(arrays, 'trip', pairs)
+    positions = [pairs.get_indexer(agg['trip'].index) for agg in cell_aggs]
+    arrays['trip_cell'] = np.repeat(np.arange(len(cells)), [len(pos) for pos in positions]).astype(np.int16)
+    arrays['trip_pos'] = np.concatenate(positions + [np.array([], dtype=np.int64)]).astype(np.int32)
+    arrays['trip_count'] = np.concatenate([agg['trip'].to_numpy() for agg in cell_aggs] +
+                                          [np.array([], dtype=np.int64)])
+
+    arrays['source'] = np.array(json.dumps({'version': CACHE_VERSION, 'source': fingerprint}))
+    # write to a temporary file first so a crash or a concurrent reader never sees a partial cube
+    path = os.path.join(city_cache_dir(city), 'cube.npz')
+    tmp = path[:-len('.npz')] + '.tmp{}.npz'.format(os.getpid())
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
 
+
+def load_cube(city):
+
+    """
+    Loads the rollup cube of a city, (re)building it if it is missing or the csv file changed.
+
+    Args:
+        (str) city - name of the city
     Returns:
-        (str) city - name of the city to analyze
+        (dict) cube - cube arrays by name, labels already converted to Pandas Index objects
+    """
+    path = os.path.join(city_cache_dir(city), 'cube.npz')
+    # the csv file changed: rebuild the columnar cache first, the outdated cube no longer matches it
+    ensure_cache(city)
+    with span('cube.load'):
+        cube = read_cube(city, path)
+    if cube is None:
+        with cache_lock(city):
+            # another process may have built the cube while this one waited for the lock
+            cube = read_cube(city, path)
+            if cube is None:
+                with span('cube.build'):
+                    write_cube(city)
+                cube = read_cube(city, path)
+    return cube
+
+
+def read_cube(city, path):
+    """Reads the cube file of a city and converts its labels, None if it is missing or outdated, see load_cube."""
+    try:
+        with np.load(path) as npz:
+            cube = {name: npz[name] for name in npz.files}
+        source = json.loads(str(cube.pop('source')))
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # an unreadable cube (e.g. truncated by a crash) is treated like a missing one
+        return None
+    if source != {'version': CACHE_VERSION, 'source': source_fingerprint(city)}:
+        return None
+
+    for key in CUBE_TABLES:
+        if key + '_labels' in cube:
+            cube[key + '_labels'] = labels_from_arrays(cube, key)
+    cube['trip_pairs'] = labels_from_arrays(cube, 'trip')
+    return cube
+
+
+def cube_aggregate(cube, month, day):
+
+    """
+    Answers a month/day query from the rollup cube by merging the matching cells.
+
+    Args:
+        (dict) cube - cube as returned by load_cube
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        (dict) agg - aggregate equal to aggregate(load_data(city, month, day))
     """
-    # request user input (city, month, weekday)
-    print('Hello! Let\'s explore some US bikeshare data!')
-    city = input("Please choose which city data to analyse. Options are Chicago, New York City, Washington: ").lower()
-    cities = list(CITY_DATA.keys())
+    month_no, weekday_no = filter_keys(month, day)
+    selected = np.ones(len(cube['cells']), dtype=bool)
+    if month_no is not None:
+        selected &= cube['cells'][:, 0] == month_no
+    if weekday_no is not None:
+        selected &= cube['cells'][:, 1] == weekday_no
 
-    # make sure only predefined input as defined above is chosen
-    while not(city in cities):
-        city = input("Input is not part of the options Chicago, New York City, Washington, "
-                     "Must be a typo as no case sensitivity is applied. Please re-enter city name: ").lower()
+    agg = {'rows': int(cube['rows'][selected].sum())}
+    timings = agg['timings'] = {}
+    with span('cube.duration') as record:
+        agg['duration_sum'] = float(cube['duration_sum'][selected].sum())
+        agg['duration_count'] = int(cube['duration_count'][selected].sum())
+    timings['duration'] = record['seconds']
+    for key in CUBE_TABLES:
+        if key + '_counts' not in cube:
+            agg[key] = None
+            continue
+        with span('cube.' + key) as record:
+            counts = cube[key + '_counts'][selected].sum(axis=0)
+            present = np.flatnonzero(counts)
+            agg[key] = pd.Series(counts[present], index=cube[key + '_labels'][present], dtype=np.int64)
+        timings[key] = record['seconds']
 
-    month = input("Please choose which month between January and June to analyse "
-                  "or enter all to analyse all months at once: ").lower()
-    while not (month in MONTH_DATA):
-        month = input(
-            "Input is not part of the options {}. Must be a typo as no case sensitivity is applied. "
-            "Please re-enter month name: ".format(MONTH_DATA)).lower()
+    # station pairs: add up the sparse counts of the selected cells per pair
+    with span('cube.trip') as record:
+        in_cells = selected[cube['trip_cell']]
+        counts = np.bincount(cube['trip_pos'][in_cells], weights=cube['trip_count'][in_cells],
+                             minlength=len(cube['trip_pairs'])).astype(np.int64)
+        present = np.flatnonzero(counts)
+        agg['trip'] = pd.Series(counts[present], index=cube['trip_pairs'][present], dtype=np.int64)
+    timings['trip'] = record['seconds']
+    return agg
 
-    day = input("Please choose the weekday of interest or enter all to analyse all weekdays at once: ").lower()
-    while not (day in WEEKDAY_DATA):
-        day = input(
-            "Input is not part of the options {}. Must be a typo as no case sensitivity is applied. "
-            "Please re-enter weekday name: ".format(WEEKDAY_DATA)).lower()
 
-    print('-'*40)
-    print('get_filters done')
-    return city, month, day
+def enable_result_cache(directory=None, size=RESULT_CACHE_SIZE, entries=RESULT_CACHE_ENTRIES,
+                        disk_bytes=RESULT_CACHE_DISK_BYTES):
+
+    """
+    Configures the cache of query results, the least recently used results are dropped once a limit is reached.
 
+    Args:
+        (str) directory - directory to also keep the cached results in between runs, None to keep them in memory
+        (int) size - number of results kept in memory (and on disk)
+        (int) entries - number of count table entries (values and station pairs) kept in memory
+        (int) disk_bytes - size of the result files kept on disk
+    """
+    global RESULT_CACHE_DIR, RESULT_CACHE_SIZE, RESULT_CACHE_ENTRIES, RESULT_CACHE_DISK_BYTES
+    RESULT_CACHE_DIR = directory
+    RESULT_CACHE_SIZE = size
+    RESULT_CACHE_ENTRIES = entries
+    RESULT_CACHE_DISK_BYTES = disk_bytes
+    evict_results()
 
-def load_data(city, month, day):
+
+def result_cache_path(city, month, day):
+    """Returns the path of the on-disk cache file of a query result."""
+    return os.path.join(RESULT_CACHE_DIR, '{}_{}_{}.npz'.format(city.replace(' ', '_'), month, day))
+
+
+def cached_aggregate(city, month, day, fingerprint=None):
 
     """
-    Loads data for the specified city and filters by month and day if applicable.
+    Looks up the aggregate of a query in the result cache.
+
+    A missing "all" query is derived from cached finer queries if there are enough of them: all months of the
+    day, all weekdays of the month, or either for "all"/"all", merged like partial aggregates. The merge is only
+    used if it covers every row of the query according to the columnar cache, rows of other months or without a
+    start time are in none of the finer queries.
 
     Args:
-        (str) city - name of the city to analyze
+        (str) city - name of the city
         (str) month - name of the month to filter by, or "all" to apply no month filter
         (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (dict) fingerprint - fingerprint of the city csv file, see source_fingerprint, looked up if not given
     Returns:
-        df - Pandas DataFrame containing city data filtered by month and day
+        (dict) agg - aggregate of the query, or None if it is neither cached nor derivable
     """
-    # load data file into a data frame
-    df = pd.read_csv(CITY_DATA[city])
-    print('read_csv done')
+    fingerprint = fingerprint or source_fingerprint(city)
+    with span('result_cache.lookup'):
+        agg = lookup_aggregate(city, month, day, fingerprint)
+    return dict(agg) if agg is not None else None
 
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
 
-    # extract hour, month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['hour'] = df['Start Time'].dt.hour
-    df['day_of_week'] = df['Start Time'].dt.day_name()
+def lookup_aggregate(city, month, day, fingerprint):
+    """Finds a cached aggregate or derives it from finer cached ones, see cached_aggregate."""
+    agg = read_cached_aggregate(city, month, day, fingerprint)
+    if agg is not None:
+        return agg
+    # counts are additive: a query over all months (days) is the merge of the queries of every month (day)
+    splits = []
+    if month == 'all':
+        splits.append([(part, day) for part in MONTH_DATA if part != 'all'])
+    if day == 'all':
+        splits.append([(month, part) for part in WEEKDAY_DATA if part != 'all'])
+    for parts in splits:
+        aggs = []
+        for part_month, part_day in parts:
+            part = lookup_aggregate(city, part_month, part_day, fingerprint)
+            if part is None:
+                break
+            aggs.append(part)
+        else:
+            if sum(part['rows'] for part in aggs) != query_rows(city, month, day, fingerprint):
+                continue
+            agg = merge_aggregates(aggs)
+            store_aggregate(city, month, day, agg, fingerprint)
+            return agg
+    return None
 
-    # filter by month if applicable
-    if month != 'all':
-        # use the index of the months list to get the corresponding int
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
 
-        # filter by month to create the new dataframe
-        df = df[df['month'] == month]
+def query_rows(city, month, day, fingerprint):
+    """Returns the number of rows matching a query according to the columnar cache, None without a current cache."""
+    meta = read_cache_meta(city)
+    if meta is None or meta['source'] != fingerprint:
+        return None
+    return sum(stop - start for start, stop in select_partitions(meta, month, day))
 
-    # filter by day of week if applicable
-    if day != 'all':
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
 
-    # show slices of five raw data rows per user request
-    show5 = input("Would you like to see five rows of the raw data?").lower()
-    # show_counter is used to derive which 5 rows to show in below print statement, initial set = 1 for first five rows
-    show5_counter = 1
-    # make sure only predefined input is chosen
-    while not(show5.lower() in SHOW_ROWS):
-        show5 = input("Input is neither yes nor no, please choose one of those options.").lower()
-    while show5.lower() == 'yes':
-        # print "next" five rows
-        print(df.iloc[(show5_counter-1)*5:show5_counter*5, ])
-        show5 = input("Would you like to see another 5 rows of data?").lower()
-        while not(show5.lower() in SHOW_ROWS):
-            show5 = input("Input is neither yes nor no, please choose one of those options.").lower()
-        # if user choice is still "yes" shift the rows to be shown in next print statement by multiplier of 5
-        show5_counter += 1
+def read_cached_aggregate(city, month, day, fingerprint):
+    """Returns the exactly matching cached aggregate of a query, from memory or disk, or None."""
+    key = (city, month, day, json.dumps(fingerprint, sort_keys=True))
+    if key in RESULT_CACHE:
+        RESULT_CACHE.move_to_end(key)
+        return RESULT_CACHE[key]
+    if RESULT_CACHE_DIR is None:
+        return None
+    path = result_cache_path(city, month, day)
+    try:
+        with np.load(path) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        source = json.loads(str(arrays.pop('source')))
+        agg = aggregate_from_arrays(arrays)
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # missing, just evicted by another process sharing the directory, or unreadable: a cache miss
+        return None
+    if source != {'version': CACHE_VERSION, 'source': fingerprint}:
+        # the csv file changed since the result was stored
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        return None
+    # mark the file as recently used for the eviction of the disk cache
+    with contextlib.suppress(OSError):
+        os.utime(path)
+    remember_aggregate(key, agg)
+    return agg
+
+
+def store_aggregate(city, month, day, agg, fingerprint=None):
+
+    """
+    Puts the aggregate of a query into the result cache, dropping the least recently used results if it is full.
+
+    Args:
+        (str) city - name of the city
+        (str) month - month filter of the query
+        (str) day - day filter of the query
+        (dict) agg - aggregate of the query
+        (dict) fingerprint - fingerprint of the city csv file the aggregate was computed from
+    """
+    fingerprint = fingerprint or source_fingerprint(city)
+    remember_aggregate((city, month, day, json.dumps(fingerprint, sort_keys=True)), agg)
+    if RESULT_CACHE_DIR is None:
+        return
+    with span('result_cache.write'):
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        arrays = aggregate_arrays(agg)
+        arrays['source'] = np.array(json.dumps({'version': CACHE_VERSION, 'source': fingerprint}))
+        # write to a temporary file first so readers never see a partial file
+        path = result_cache_path(city, month, day)
+        tmp = path[:-len('.npz')] + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+        # drop the least recently used files while there are too many or they are too large together, other
+        # processes sharing the directory may remove files at the same time
+        files = []
+        for entry in os.scandir(RESULT_CACHE_DIR):
+            if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for count, (_, size, stale) in enumerate(files):
+            if len(files) - count <= RESULT_CACHE_SIZE and total <= RESULT_CACHE_DISK_BYTES:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(stale)
+            total -= size
+
+
+def remember_aggregate(key, agg):
+    """Keeps an aggregate in the in-memory result cache, evicting the least recently used ones."""
+    city, fingerprint = key[0], key[3]
+    # results of an older version of the csv file can never be hit again
+    for stale in [other for other in RESULT_CACHE if other[0] == city and other[3] != fingerprint]:
+        del RESULT_CACHE[stale]
+    # a cached result costs no computing time when it is hit, merging derived results is timed anew
+    RESULT_CACHE[key] = dict(agg, timings={})
+    RESULT_CACHE.move_to_end(key)
+    evict_results()
+
+
+def evict_results():
+    """Drops the least recently used results while the in-memory result cache exceeds one of its limits."""
+    entries = sum(table_entries(agg) for agg in RESULT_CACHE.values())
+    while RESULT_CACHE and (len(RESULT_CACHE) > RESULT_CACHE_SIZE or entries > RESULT_CACHE_ENTRIES):
+        entries -= table_entries(RESULT_CACHE.popitem(last=False)[1])
+
+
+def table_entries(agg):
+    """Returns the number of count table entries of an aggregate, a measure of its size."""
+    return sum(len(agg[key]) for key in list(CUBE_TABLES) + ['trip'] if agg[key] is not None)
+
+
+def aggregate_arrays(agg):
+    """Converts an aggregate into plain NumPy arrays that can be stored without pickle."""
+    arrays = {key: np.array(agg[key]) for key in ('rows', 'duration_sum', 'duration_count')}
+    for key in list(CUBE_TABLES) + ['trip']:
+        if agg[key] is not None:
+            label_arrays(arrays, key, agg[key].index)
+            arrays[key + '_counts'] = agg[key].to_numpy(dtype=np.int64)
+    return arrays
+
+
+def aggregate_from_arrays(arrays):
+    """Rebuilds an aggregate stored by aggregate_arrays."""
+    agg = {'rows': int(arrays['rows']), 'duration_sum': float(arrays['duration_sum']),
+           'duration_count': int(arrays['duration_count']), 'timings': {}}
+    for key in list(CUBE_TABLES) + ['trip']:
+        agg[key] = None
+        if key + '_counts' in arrays:
+            agg[key] = pd.Series(arrays[key + '_counts'], index=labels_from_arrays(arrays, key), dtype=np.int64)
+    return agg
+
+
+def top_counts(counts, k):
+
+    """
+    Picks the k most frequent values of a count table with a heap, the smallest value first on ties.
+
+    Args:
+        counts - Pandas Series of counts indexed by value, or (value, count) pairs
+        (int) k - number of values to pick
+    Returns:
+        (list) top - (value, count) pairs, most frequent first
+    """
+    items = counts.items() if isinstance(counts, pd.Series) else counts
+    return heapq.nsmallest(k, items, key=lambda item: (-item[1], item[0]))
+
+
+def mix_hashes(keys, seed):
+    """Remixes 64 bit hashes with a seed (splitmix64 finalizer), one independent hash function per seed."""
+    with np.errstate(over='ignore'):
+        mixed = keys + np.uint64((seed + 1) * 0x9E3779B97F4A7C15 % (1 << 64))
+        mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return mixed ^ (mixed >> np.uint64(31))
+
+
+def count_min_sketch(epsilon=TOP_K_EPSILON, delta=TOP_K_DELTA, capacity=None):
+
+    """
+    Creates an empty Count-Min sketch that also keeps the candidates for the most frequent keys.
+
+    Memory is bounded by the error bounds, not by the number of distinct keys: the sketch has ceil(e / epsilon)
+    counters in each of ceil(ln(1 / delta)) rows, plus at most capacity candidates.
+
+    Args:
+        (float) epsilon - estimated counts exceed the true counts by at most epsilon * total count ...
+        (float) delta - ... with probability 1 - delta
+        (int) capacity - number of candidates kept, defaults to ceil(1 / epsilon)
+    Returns:
+        (dict) sketch - counter table, total count and candidate labels by key
+    """
+    width = int(np.ceil(np.e / epsilon))
+    depth = max(1, int(np.ceil(np.log(1 / delta))))
+    return {'table': np.zeros((depth, width), dtype=np.int64), 'total': 0, 'epsilon': epsilon, 'delta': delta,
+            'capacity': capacity or int(np.ceil(1 / epsilon)), 'candidates': {}}
+
+
+def count_min_estimate(sketch, keys):
+    """Returns the estimated counts of 64 bit keys, never below the true counts."""
+    width = sketch['table'].shape[1]
+    estimates = [row[mix_hashes(keys, seed) % np.uint64(width)] for seed, row in enumerate(sketch['table'])]
+    return np.min(estimates, axis=0) if estimates else np.zeros(len(keys), dtype=np.int64)
+
+
+def update_count_min(sketch, keys, counts, labels):
+
+    """
+    Adds counted keys to a Count-Min sketch and updates its candidates for the most frequent keys.
+
+    A key dropped from the candidates only comes back if it occurs again, its estimate can only have been at
+    most the lowest kept one when it was dropped, so no key above the final cut off is lost.
+
+    Args:
+        (dict) sketch - sketch as returned by count_min_sketch
+        (ndarray) keys - distinct 64 bit keys of this batch
+        (ndarray) counts - number of occurrences of every key in this batch
+        (list) labels - value behind every key, reported by sketch_top
+    """
+    width = sketch['table'].shape[1]
+    for seed, row in enumerate(sketch['table']):
+        row += np.bincount((mix_hashes(keys, seed) % np.uint64(width)).astype(np.int64), weights=counts,
+                           minlength=width).astype(np.int64)
+    sketch['total'] += int(np.sum(counts))
+
+    # keep the candidates with the highest estimates, new keys of this batch included
+    candidates = sketch['candidates']
+    candidates.update(zip(keys.tolist(), labels))
+    if len(candidates) > sketch['capacity']:
+        kept = list(candidates)
+        estimates = count_min_estimate(sketch, np.array(kept, dtype=np.uint64))
+        cut = np.argpartition(-estimates, sketch['capacity'] - 1)[:sketch['capacity']]
+        sketch['candidates'] = {kept[i]: candidates[kept[i]] for i in cut}
+
+
+def merge_count_min(sketches):
+    """Merges Count-Min sketches of disjoint parts of the data, created with the same error bounds."""
+    merged = dict(sketches[0], table=np.sum([sketch['table'] for sketch in sketches], axis=0),
+                  total=sum(sketch['total'] for sketch in sketches), candidates={})
+    for sketch in sketches:
+        merged['candidates'].update(sketch['candidates'])
+    # trim the candidates back to the capacity by their merged estimates
+    update_count_min(merged, np.array([], dtype=np.uint64), np.array([], dtype=np.int64), [])
+    return merged
+
+
+def sketch_top(sketch, k):
+    """Returns the k candidates with the highest estimated counts as (value, estimate) pairs."""
+    keys = list(sketch['candidates'])
+    estimates = count_min_estimate(sketch, np.array(keys, dtype=np.uint64))
+    return top_counts([(sketch['candidates'][key], int(estimate)) for key, estimate in zip(keys, estimates)], k)
 
-    print('load_data done')
-    return df
 
+def hyperloglog(precision=HLL_PRECISION):
+    """Creates the empty registers of a HyperLogLog distinct counter, 2 ** precision bytes."""
+    return np.zeros(1 << precision, dtype=np.uint8)
 
-def time_stats(df, city, month, day):
+
+def update_hyperloglog(registers, keys):
+
+    """
+    Adds 64 bit keys to a HyperLogLog distinct counter.
+
+    Args:
+        (ndarray) registers - registers as returned by hyperloglog, updated in place
+        (ndarray) keys - 64 bit keys, duplicates are fine
+    """
+    precision = int(np.log2(len(registers)))
+    keys = mix_hashes(keys, -1)
+    bucket = (keys >> np.uint64(64 - precision)).astype(np.int64)
+    rest = keys & np.uint64((1 << (64 - precision)) - 1)
+    # the register keeps the highest position of the first set bit of the remaining bits, counted from the left;
+    # bit lengths come from frexp of both 32 bit halves, which float64 represents exactly
+    high = frexp_bits(rest >> np.uint64(32))
+    bits = np.where(high > 0, high + 32, frexp_bits(rest & np.uint64(0xFFFFFFFF)))
+    np.maximum.at(registers, bucket, (64 - precision - bits + 1).astype(np.uint8))
+
+
+def frexp_bits(values):
+    """Returns the bit length of unsigned integers below 2 ** 32."""
+    return np.frexp(values.astype(np.float64))[1]
+
+
+def hyperloglog_count(registers):
+    """Estimates the number of distinct keys added to HyperLogLog registers (merge registers with np.maximum)."""
+    size = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / size) * size ** 2 / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    empty = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * size and empty:
+        # few keys: linear counting over the empty registers is more accurate
+        estimate = size * np.log(size / empty)
+    return int(round(estimate))
+
+
+def iter_station_chunks(city, month='all', day='all', chunksize=STREAM_CHUNKSIZE):
+
+    """
+    Reads the start and end stations of a city chunk by chunk.
+
+    Small city files are read from the memory mapped cache, files larger than STREAM_THRESHOLD_BYTES straight
+    from the csv file, so no more than one chunk is held in memory either way.
+
+    Args:
+        (str) city - name of the city
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) chunksize - number of rows per chunk
+    Returns:
+        generator of Pandas DataFrames with the Start Station and End Station columns
+    """
+    if needs_streaming(city):
+        for chunk in iter_city_chunks(city, month, day, chunksize):
+            yield chunk[['Start Station', 'End Station']]
+        return
+    meta = ensure_cache(city)
+    # neighbouring partitions are read as one range, chunks do not need to follow partition borders
+    ranges = []
+    for start, stop in select_partitions(meta, month, day):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    for start, stop in ranges:
+        for first in range(start, stop, chunksize):
+            yield read_ranges(city, meta, [(first, min(first + chunksize, stop))],
+                              columns=['Start Station', 'End Station'])
+
+
+def sketch_stations(chunks, epsilon=TOP_K_EPSILON, delta=TOP_K_DELTA, precision=HLL_PRECISION, capacity=None):
+
+    """
+    Streams station data through Count-Min sketches of the start stations, end stations and routes and a
+    HyperLogLog counter of the distinct routes.
+
+    Args:
+        chunks - iterable of Pandas DataFrames with Start Station and End Station columns
+        (float) epsilon - error bound of the counts, see count_min_sketch
+        (float) delta - probability of exceeding the error bound
+        (int) precision - HyperLogLog precision
+        (int) capacity - candidates kept per sketch, see count_min_sketch
+    Returns:
+        (dict) sketches - Count-Min sketch per table of TOP_K_TABLES, rows and the 'distinct_trips' registers
+    """
+    sketches = {key: count_min_sketch(epsilon, delta, capacity) for key in TOP_K_TABLES}
+    sketches['distinct_trips'] = hyperloglog(precision)
+    sketches['rows'] = 0
+    for chunk in chunks:
+        with span('sketch.chunk', rows=len(chunk)):
+            sketches['rows'] += len(chunk)
+            start_codes, end_codes, labels = station_codes(chunk['Start Station'], chunk['End Station'])
+            if not len(labels):
+                continue
+            label_keys = pd.util.hash_array(labels.to_numpy(dtype=object))
+            names = labels.to_numpy(dtype=object)
+            for key, codes in (('start_station', start_codes), ('end_station', end_codes)):
+                counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+                present = np.flatnonzero(counts)
+                update_count_min(sketches[key], label_keys[present], counts[present], names[present].tolist())
+
+            # routes: count the pairs of this chunk first so every distinct pair is hashed once
+            valid = (start_codes >= 0) & (end_codes >= 0)
+            pairs, counts = np.unique(start_codes[valid].astype(np.int64) * len(labels) + end_codes[valid],
+                                      return_counts=True)
+            starts, ends = pairs // len(labels), pairs % len(labels)
+            pair_keys = mix_hashes(label_keys[starts], 0) ^ label_keys[ends]
+            update_count_min(sketches['trip'], pair_keys, counts, list(zip(names[starts], names[ends])))
+            update_hyperloglog(sketches['distinct_trips'], pair_keys)
+    return sketches
+
+
+def top_k(city, month='all', day='all', k=10, method='exact', epsilon=TOP_K_EPSILON, delta=TOP_K_DELTA,
+          precision=HLL_PRECISION):
+
+    """
+    Finds the k most popular start stations, end stations and routes of a query and counts the distinct routes.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (int) k - number of stations and routes to report
+        (str) method - "exact" to pick them from the exact count tables with a heap, "approx" to stream the data
+                       through Count-Min sketches and a HyperLogLog counter with bounded memory
+        (float) epsilon - approximate counts exceed the true counts by at most epsilon * rows ...
+        (float) delta - ... with probability 1 - delta
+        (int) precision - HyperLogLog precision, the distinct route count has a relative standard error of
+                          about 1.04 / sqrt(2 ** precision)
+    Returns:
+        (dict) top - (value, count) pairs, most popular first, per table of TOP_K_TABLES, 'distinct_trips',
+                     'rows' and the bounds 'count_error' (absolute) and 'distinct_error' (relative), 0 if exact
+    """
+    city, month, day = check_query(city, month, day)
+    if method not in TOP_K_METHODS:
+        raise ValueError('unknown top-K method {!r}, options are {}'.format(method, TOP_K_METHODS))
+    with span('top_k.' + method):
+        if method == 'exact':
+            return top_k_aggregate(get_aggregate(city, month, day), k)
+        sketches = sketch_stations(iter_station_chunks(city, month, day), epsilon, delta, precision,
+                                   capacity=max(k, int(np.ceil(1 / epsilon))))
+        top = {key: sketch_top(sketches[key], k) for key in TOP_K_TABLES}
+        top.update(rows=sketches['rows'], distinct_trips=hyperloglog_count(sketches['distinct_trips']),
+                   count_error=int(np.ceil(epsilon * sketches['trip']['total'])),
+                   distinct_error=1.04 / np.sqrt(1 << precision))
+        return top
+
+
+def top_k_aggregate(agg, k=10):
+    """Finds the k most popular stations and routes of an aggregate exactly, see top_k."""
+    top = {key: top_counts(agg[key], k) for key in TOP_K_TABLES}
+    top.update(rows=agg['rows'], distinct_trips=len(agg['trip']), count_error=0, distinct_error=0.0)
+    return top
+
+
+def top_k_record(city, month, day, top):
+    """Converts the result of top_k into plain Python types, see stats_record."""
+    record = {'city': city, 'month': month, 'day': day}
+    for key, value in top.items():
+        if key in TOP_K_TABLES:
+            value = [{'value': [str(item) for item in label] if isinstance(label, tuple) else str(label),
+                      'count': int(count)} for label, count in value]
+        record[key] = value
+    return record
+
+
+def time_stats(stats, city, month, day):
     """Displays statistics on the most frequent times of travel."""
 
     print('\nCalculating The Most Frequent Times of Travel...\n')
-    # track start time to calculate time required for calculations
-    start_time = time.time()
-    # define the mode of the column month, limit to month number via [0] and convert to name
-    popular_month = calendar.month_name[df['month'].mode()[0]]
+    # look up the most common month and convert to name
+    popular_month = calendar.month_name[stats['popular_month']]
     # print results, case separation to phrase sentences with 'all' correctly
     if day == 'all' and month == 'all':
         print('The most common month for sharing bikes on all days in {} is {}'
@@ -128,8 +2021,8 @@ def time_stats(df, city, month, day):
     else:
         print('It is meaningless to search for the most common month as a month has been specified for filtering!')
 
-    # define the mode of the column day of week, limit to the day via [0]
-    popular_day = df['day_of_week'].mode()[0]
+    # look up the most common day of week
+    popular_day = stats['popular_day']
     # print results, case separation to phrase sentences with 'all' correctly
     if day == 'all' and month == 'all':
         print('The most common day for sharing bikes during all months in {} is {}'
@@ -140,8 +2033,8 @@ def time_stats(df, city, month, day):
     else:
         print('It is meaningless to search for the most common weekday as a day has been specified for filtering!')
 
-    # define the mode of the column hour, limit to hour number via [0]
-    popular_hour = df['hour'].mode()[0]
+    # look up the most common hour
+    popular_hour = stats['popular_hour']
     # print results, case separation to phrase sentences with 'all' correctly
     if month == 'all' and day == 'all':
         print('The most common hour for sharing bikes during all months across weekdays in {} is {}'
@@ -155,19 +2048,17 @@ def time_stats(df, city, month, day):
     else:
         print('The most common hour for sharing bikes during {} on a {} in {} is {}'
               .format(month.title(), day.title(), city.title(), popular_hour))
-    # track computation time (compare start_time above) & print
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    # print the time spent computing these statistics, formatting and printing excluded
+    print("\nThis took %s seconds." % section_seconds(stats, 'time_stats'))
     print('-'*40)
 
 
-def station_stats(df, city, month, day):
+def station_stats(stats, city, month, day):
     """Displays statistics on the most popular stations and trip."""
 
     print('\nCalculating The Most Popular Stations and Trip...\n')
-    # track start time to calculate time required for calculations
-    start_time = time.time()
-    # define the mode of the column start station, limit to its name number via [0]
-    popular_start = df['Start Station'].mode()[0]
+    # look up the most common start station
+    popular_start = stats['popular_start']
     # print results, case separation to phrase sentences with 'all' correctly
     if month == 'all' and day == 'all':
         print('The most common starting station for trips with shared bikes during all months across weekdays '
@@ -182,8 +2073,8 @@ def station_stats(df, city, month, day):
         print('The most common starting station for trips with shared bikes during {} on a {} in {} is {}'
               .format(month.title(), day.title(), city.title(), popular_start))
 
-    # define the mode of the column end station, limit to its name number via [0]
-    popular_end = df['End Station'].mode()[0]
+    # look up the most common end station
+    popular_end = stats['popular_end']
     # print results, case separation to phrase sentences with 'all' correctly
     if month == 'all' and day == 'all':
         print('The most common end station for trips with shared bikes during all months across weekdays in {} is {}'
@@ -198,10 +2089,9 @@ def station_stats(df, city, month, day):
         print('The most common end station for trips with shared bikes during {} on a {} in {} is {}'
               .format(month.title(), day.title(), city.title(), popular_end))
 
-    # define the maximum index of dataset grouped by start and end station (counts),
+    # look up the most common start and end station combination,
     # read out this tuple in two separate variables
-    popular_combi_start, popular_combi_end = df.groupby(['Start Station', 'End Station'])['Start Station']\
-        .count().idxmax()
+    popular_combi_start, popular_combi_end = stats['popular_trip']
     # print results, case separation to phrase sentences with 'all' correctly
     if month == 'all' and day == 'all':
         print('The most common start- and end station combination for trips with shared bikes during all months '
@@ -216,19 +2106,17 @@ def station_stats(df, city, month, day):
         print('The most common start- and end station for trips with shared bikes '
               'during {} on a {} in {} is from {} to {}'
               .format(month.title(), day.title(), city.title(), popular_combi_start, popular_combi_end))
-    # track computation time (compare start_time above) & print
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    # print the time spent computing these statistics, formatting and printing excluded
+    print("\nThis took %s seconds." % section_seconds(stats, 'station_stats'))
     print('-'*40)
 
 
-def trip_duration_stats(df, city, month, day):
+def trip_duration_stats(stats, city, month, day):
     """Displays statistics on the total and average trip duration."""
 
     print('\nCalculating Trip Duration...\n')
-    # track start time to calculate time required for calculations
-    start_time = time.time()
-    # calculate the total time of all trips in the dataframe
-    travel_sec = df['Trip Duration'].sum()
+    # look up the total time of all trips
+    travel_sec = stats['travel_total']
 
     # to prepare conversion of seconds to days / hours / minutes: define how many seconds each of these is having
     sec_per_day = 60*60*24
@@ -263,8 +2151,8 @@ def trip_duration_stats(df, city, month, day):
               'is {} day(s), {} hour(s), {} minute(s), {} second(s)'
               .format(month.title(), day.title(), city.title(), travel_days, travel_hrs, travel_mins, travel_secs))
 
-    # define the mean of all trips in dataframe
-    travel_sec = df['Trip Duration'].mean()
+    # look up the mean of all trips
+    travel_sec = stats['travel_mean']
 
     # compare above: slicing the seconds in days, hours and minutes.
     # As above variables are not used anymore overwrite those is ok
@@ -291,22 +2179,18 @@ def trip_duration_stats(df, city, month, day):
               'in {} is {} day(s), {} hour(s), {} minute(s), {} second(s)'
               .format(month.title(), day.title(), city.title(), travel_days, travel_hrs, travel_mins, travel_secs))
 
-    # track computation time (compare start_time above) & print
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    # print the time spent computing these statistics, formatting and printing excluded
+    print("\nThis took %s seconds." % section_seconds(stats, 'trip_duration_stats'))
     print('-'*40)
 
 
-def user_stats(df, city, month, day):
+def user_stats(stats, city, month, day):
     """Displays statistics on bikeshare users."""
 
     print('\nCalculating User Stats...\n')
-    # track start time to calculate time required for calculations
-    start_time = time.time()
-    # extract user types per dataframe via group by statement.
-    # As Start Station is filled for each trip use this variable
+    # format the user type counts as a table,
     # remove indices and convert to string to make readable in print statement
-    user_types = df.groupby(['User Type'], as_index=False)['Start Station'].count()\
-        .rename(columns={'Start Station': 'Total_Numbers'}).to_string(index=False)
+    user_types = stats['user_types'].reset_index(name='Total_Numbers').to_string(index=False)
 
     # print results, case separation to phrase sentences with 'all' correctly
     if month == 'all' and day == 'all':
@@ -327,11 +2211,9 @@ def user_stats(df, city, month, day):
     if city == 'washington':
         print('No information on gender and date of birth available in the dataset for Washington')
     else:
-        # extract genders per dataframe via group by statement.
-        # As Start Station is filled for each trip use this variable
+        # format the gender counts as a table,
         # remove indices and convert to string to make readable in print statement
-        genders = df.groupby(['Gender'], as_index=False)['Start Station'].count().rename(
-            columns={'Start Station': 'Total_Numbers'}).to_string(index=False)
+        genders = stats['genders'].reset_index(name='Total_Numbers').to_string(index=False)
         # print results, case separation to phrase sentences with 'all' correctly
         if month == 'all' and day == 'all':
             print('The following genders were counted while analysing trips with shared bikes '
@@ -346,10 +2228,10 @@ def user_stats(df, city, month, day):
             print('The following genders were counted while analysing trips with shared bikes '
                   'during {} on a {} in {}: \n \n {}'.format(month.title(), day.title(), city.title(), genders))
 
-        # define smallest, most occuring and highest year of birth
-        youngest_yob = int(df['Birth Year'].max())
-        oldest_yob = int(df['Birth Year'].min())
-        most_yob = int(df['Birth Year'].mode())
+        # look up smallest, most occuring and highest year of birth
+        youngest_yob = stats['youngest_yob']
+        oldest_yob = stats['oldest_yob']
+        most_yob = stats['most_yob']
 
         # print results, case separation to phrase sentences with 'all' correctly
         if month == 'all' and day == 'all':
@@ -368,30 +2250,345 @@ def user_stats(df, city, month, day):
             print('The youngest customer renting a bike in {} during {} on a {} was borne in {}, '
                   'the oldest in {} and the most customers were born in {}'
                   .format(city.title(), month.title(), day.title(), youngest_yob, oldest_yob, most_yob))
-    # track computation time (compare start_time above) & print
-    print("\nThis took %s seconds." % (time.time() - start_time))
+    # print the time spent computing these statistics, formatting and printing excluded
+    print("\nThis took %s seconds." % section_seconds(stats, 'user_stats'))
     print('-'*40)
 
 
+def check_query(city, month, day):
+
+    """
+    Validates a city, month and day query.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+    Returns:
+        (tuple) query - city, month and day in lower case
+    """
+    city, month, day = city.strip().lower(), month.strip().lower(), day.strip().lower()
+    if city not in CITY_DATA:
+        raise ValueError('unknown city {!r}, options are {}'.format(city, list(CITY_DATA)))
+    if month not in MONTH_DATA:
+        raise ValueError('unknown month {!r}, options are {}'.format(month, MONTH_DATA))
+    if day not in WEEKDAY_DATA:
+        raise ValueError('unknown day {!r}, options are {}'.format(day, WEEKDAY_DATA))
+    return city, month, day
+
+
+def get_stats(city, month='all', day='all', mode='cube', workers=None, cache=True):
+
+    """
+    Computes the statistics of one query without printing anything, reusing cached results where possible.
+
+    Args:
+        (str) city - name of the city to analyze
+        (str) month - name of the month to filter by, or "all" to apply no month filter
+        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        (str) mode - "cube" to answer from the rollup cube, "memory" to aggregate the loaded city data,
+                     "stream" to aggregate the csv file chunk by chunk, "parallel" to aggregate on a process pool;
+                     files larger than STREAM_THRESHOLD_BYTES are always streamed
+        (int) workers - number of worker processes for the "parallel" mode
+        (bool) cache - whether to look up and keep the result in the result cache, see cached_aggregate
+    Returns:
+        (dict) stats - statistics as returned by summarize
+    """
+    return summarize(get_aggregate(city, month, day, mode, workers, cache))
+
+
+def get_aggregate(city, month='all', day='all', mode='cube', workers=None, cache=True):
+    """Returns the aggregate behind the statistics of one query, see get_stats."""
+    city, month, day = check_query(city, month, day)
+    if mode not in QUERY_MODES:
+        raise ValueError('unknown mode {!r}, options are {}'.format(mode, QUERY_MODES))
+    with span('query.' + mode):
+        fingerprint = source_fingerprint(city)
+        agg = cached_aggregate(city, month, day, fingerprint) if cache else None
+        if agg is None:
+            if mode == 'stream' or needs_streaming(city):
+                agg = stream_aggregate(city, month, day)
+            elif mode == 'cube':
+                agg = cube_aggregate(load_cube(city), month, day)
+            elif mode == 'memory':
+                agg = aggregate(load_data(city, month, day))
+            else:
+                agg = parallel_aggregate(city, month, day, workers)
+            if cache:
+                store_aggregate(city, month, day, agg, fingerprint)
+        return agg
+
+
+def run_batch(queries, mode='cube', workers=None):
+
+    """
+    Computes the statistics of many queries, loading the data of every city only once.
+
+    City files larger than STREAM_THRESHOLD_BYTES are streamed instead, whatever the mode, in one pass over the
+    csv file for all queries of the city.
+
+    Args:
+        (list) queries - (city, month, day) tuples
+        (str) mode - "cube", "memory" or "parallel", see get_stats
+        (int) workers - number of worker processes for the "parallel" mode
+    Returns:
+        (list) records - one JSON serializable record per query, in query order
+    """
+    queries = [check_query(*query) for query in queries]
+    if mode not in BATCH_MODES:
+        raise ValueError('unknown batch mode {!r}, options are {}'.format(mode, BATCH_MODES))
+    results = {}
+    for city in dict.fromkeys(query[0] for query in queries):
+        if needs_streaming(city):
+            stream_batch(city, [query for query in queries if query[0] == city], results)
+
+    if mode == 'parallel':
+        # answer the queries that are not cached all at the same time, whatever city they are about
+        pending = []
+        for query in dict.fromkeys(queries):
+            if query in results:
+                continue
+            agg = cached_aggregate(*query)
+            if agg is None:
+                pending.append(query)
+            else:
+                results[query] = stats_record(*query, summarize(agg))
+        for query, agg in zip(pending, parallel_aggregates(pending, workers) if pending else []):
+            store_aggregate(*query, agg)
+            results[query] = stats_record(*query, summarize(agg))
+        return [results[query] for query in queries]
+
+    for city in dict.fromkeys(query[0] for query in queries):
+        # load (or map) the city once, only if a query of it is not cached, and answer all of its queries
+        fingerprint = source_fingerprint(city)
+        data = None
+        for query in queries:
+            if query[0] != city or query in results:
+                continue
+            _, month, day = query
+            agg = cached_aggregate(city, month, day, fingerprint)
+            if agg is None:
+                if mode == 'cube':
+                    data = load_cube(city) if data is None else data
+                    agg = cube_aggregate(data, month, day)
+                else:
+                    data = read_city(city) if data is None else data
+                    agg = aggregate(filter_data(data, month, day))
+                store_aggregate(city, month, day, agg, fingerprint)
+            results[query] = stats_record(city, month, day, summarize(agg))
+    return [results[query] for query in queries]
+
+
+def stream_batch(city, queries, results):
+    """Answers the queries of a city too large to load at once in one pass over its csv file, see run_batch."""
+    fingerprint = source_fingerprint(city)
+    pending = []
+    for query in dict.fromkeys(queries):
+        agg = cached_aggregate(*query, fingerprint)
+        if agg is None:
+            pending.append(query)
+        else:
+            results[query] = stats_record(*query, summarize(agg))
+    aggs = stream_aggregates(city, [(month, day) for _, month, day in pending]) if pending else []
+    for query, agg in zip(pending, aggs):
+        store_aggregate(*query, agg, fingerprint)
+        results[query] = stats_record(*query, summarize(agg))
+
+
+def stats_record(city, month, day, stats):
+
+    """
+    Converts the statistics of a query into plain Python types.
+
+    Args:
+        (str) city - name of the analyzed city
+        (str) month - month filter of the query
+        (str) day - day filter of the query
+        (dict) stats - statistics as returned by summarize
+    Returns:
+        (dict) record - query and statistics as JSON serializable values, count tables as {value: count};
+                        the timings are left out so identical runs give identical output (see span for timing)
+    """
+    record = {'city': city, 'month': month, 'day': day}
+    for key, value in stats.items():
+        if key == 'timings':
+            continue
+        if isinstance(value, pd.Series):
+            value = {str(label): int(count) for label, count in value.items()}
+        elif isinstance(value, tuple):
+            value = [str(item) for item in value]
+        elif isinstance(value, np.integer):
+            value = int(value)
+        elif isinstance(value, np.floating):
+            value = float(value)
+        record[key] = value
+    return record
+
+
+def write_records(records, out, output_format='json'):
+
+    """
+    Writes batch results as JSON or CSV.
+
+    Args:
+        (list) records - records as returned by run_batch
+        out - text file object to write to
+        (str) output_format - "json" for a JSON array, "csv" for one row per query (nested values as JSON)
+    """
+    if output_format == 'json':
+        json.dump(records, out, indent=2)
+        out.write('\n')
+        return
+    fields = list(dict.fromkeys(key for record in records for key in record))
+    writer = csv.DictWriter(out, fieldnames=fields)
+    writer.writeheader()
+    for record in records:
+        writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                         for key, value in record.items()})
+
+
+def read_queries(path):
+
+    """
+    Reads batch queries from a file, one "city,month,day" query per line.
+
+    Args:
+        (str) path - path of the query file, empty lines and lines starting with # are skipped
+    Returns:
+        (list) queries - (city, month, day) tuples
+    """
+    queries = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or not ''.join(row).strip() or row[0].lstrip().startswith('#'):
+                continue
+            queries.append(tuple(row))
+    return queries
+
+
+def parse_query(text):
+    """Parses a "city,month,day" command line query, month and day default to "all"."""
+    parts = [part.strip() for part in text.split(',')]
+    parts += ['all'] * (3 - len(parts))
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError('expected city,month,day but got {!r}'.format(text))
+    try:
+        return check_query(*parts)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
 def main():
     while True:
         # main script: run functions defined above in correct order
         # assign returned city, month and day as used in all functions
         city, month, day = get_filters()
 
-        df = load_data(city, month, day)
+        if needs_streaming(city):
+            # city file too large to load at once: page through and aggregate the csv chunk by chunk
+            display_raw_data(iter_pages(iter_city_chunks(city, month, day)))
+            stats = get_stats(city, month, day, mode='stream')
+        else:
+            # show slices of five raw data rows per user request, read lazily from the cache page by page
+            display_raw_data(iter_row_pages(city, month, day))
+            # answer the query from the precomputed rollup cube
+            stats = get_stats(city, month, day, mode='cube')
 
-        time_stats(df, city, month, day)
-        station_stats(df, city, month, day)
-        trip_duration_stats(df, city, month, day)
-        user_stats(df, city, month, day)
+        # the display functions below only format the result
+        for display in (time_stats, station_stats, trip_duration_stats, user_stats):
+            with span('format.' + display.__name__):
+                display(stats, city, month, day)
         # offer restart
         restart = input('\nWould you like to restart? Enter yes or no.\n')
         if restart.lower() != 'yes':
             break
 
-# run main script
 
+def cli(argv=None):
+
+    """
+    Runs the interactive session, or a batch of queries if any are given on the command line.
+
+    Args:
+        (list) argv - command line arguments, defaults to sys.argv[1:]
+    """
+    parser = argparse.ArgumentParser(description='Explore US bikeshare data interactively or in batch mode.')
+    parser.add_argument('-q', '--query', action='append', type=parse_query, default=[],
+                        help='query as "city,month,day" (month and day default to all), may be repeated')
+    parser.add_argument('-f', '--queries', metavar='FILE',
+                        help='file with one "city,month,day" query per line')
+    parser.add_argument('--all-cities', action='store_true',
+                        help='run every query (default: all months and days) for every city, with --mode parallel '
+                             'all cities at the same time')
+    parser.add_argument('--mode', choices=BATCH_MODES, default='cube',
+                        help='how the statistics are computed, city files too large to load at once are '
+                             'streamed in any mode (default: cube)')
+    parser.add_argument('--workers', type=int, help='worker processes for the parallel mode')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json', dest='output_format',
+                        help='output format (default: json)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write results to FILE instead of stdout')
+    parser.add_argument('--top', metavar='K', type=int,
+                        help='report the K most popular stations and routes and the distinct routes instead')
+    parser.add_argument('--top-method', choices=TOP_K_METHODS, default='exact',
+                        help='exact count tables or approximate sketches for --top (default: exact)')
+    parser.add_argument('--epsilon', type=float, default=TOP_K_EPSILON,
+                        help='count error bound of the approximate --top, relative to rows (default: {})'.format(
+                            TOP_K_EPSILON))
+    parser.add_argument('--result-cache', metavar='DIR',
+                        help='also keep query results in DIR so later runs can reuse them')
+    parser.add_argument('--result-cache-size', type=int, default=RESULT_CACHE_SIZE,
+                        help='number of query results kept (default: {})'.format(RESULT_CACHE_SIZE))
+    parser.add_argument('--result-cache-entries', type=int, default=RESULT_CACHE_ENTRIES,
+                        help='count table entries (station pairs, ...) kept in memory (default: {})'.format(
+                            RESULT_CACHE_ENTRIES))
+    parser.add_argument('--trace', metavar='FILE', help='append a JSON line per instrumented span to FILE')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also trace Python allocations per span with tracemalloc (slower)')
+    parser.add_argument('--profile', metavar='FILE', help='write a cProfile/pstats dump of the run to FILE')
+    args = parser.parse_args(argv)
+    enable_result_cache(args.result_cache, args.result_cache_size, args.result_cache_entries)
+    if args.trace:
+        enable_trace(args.trace, args.trace_memory)
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run_cli(parser, args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    else:
+        run_cli(parser, args)
+
+
+def run_cli(parser, args):
+    """Runs the interactive session or the batch described by the parsed command line arguments."""
+
+    queries = list(args.query)
+    if args.queries:
+        try:
+            queries += [check_query(*(list(row) + ['all'] * (3 - len(row)))) for row in read_queries(args.queries)]
+        except (OSError, TypeError, ValueError) as error:
+            parser.error('invalid query file: {}'.format(error))
+    if args.all_cities:
+        queries = queries or [(None, 'all', 'all')]
+        queries = [(city, month, day) for _, month, day in queries for city in CITY_DATA]
+    if not queries:
+        main()
+        return
+
+    if args.top:
+        records = [top_k_record(*query, top_k(*query, k=args.top, method=args.top_method, epsilon=args.epsilon))
+                   for query in queries]
+    else:
+        records = run_batch(queries, mode=args.mode, workers=args.workers)
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write_records(records, out, args.output_format)
+    else:
+        write_records(records, sys.stdout, args.output_format)
 
+
+# run main script
 if __name__ == "__main__":
-    main()
+    cli()
@@ -0,0 +1,267 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import bikeshare_
+
+# benchmark suite for bikeshare_.py: generates synthetic trip data with the schema of the city csv files,
+# times every stage on it and writes one JSON record per stage, so runs can be compared to catch regressions
+
+# synthetic data covers the same half year as the real exports
+FIRST_DAY = np.datetime64('2017-01-01T00:00:00')
+SECONDS = 181 * 24 * 60 * 60
+STATIONS = 600
+GENERATOR_CHUNK = 1000000
+
+
+def make_trips(rows, city='chicago', seed=0, first_row=0, total_rows=None):
+
+    """
+    Generates synthetic trips with the columns of the city csv files.
+
+    Args:
+        (int) rows - number of trips to generate
+        (str) city - city whose schema to use, Washington has no Gender and Birth Year columns
+        (int) seed - random seed, the same seed gives the same trips
+        (int) first_row - number of the first row, used for the unnamed index column
+        (int) total_rows - number of rows of the whole file if this is one chunk of it, trips of a chunk then
+                           start in the matching slice of the half year so the file stays ordered by start time
+    Returns:
+        df - Pandas DataFrame with Start Time, End Time, Trip Duration, Start Station, End Station, User Type
+             and, except for Washington, Gender and Birth Year, indexed by row number
+    """
+    rng = np.random.default_rng([seed, first_row])
+    stations = np.array(['Station {:03d}'.format(i) for i in range(STATIONS)], dtype=object)
+
+    # trips start anywhere in (their slice of) the half year, durations are log normal like real rental times
+    total_rows = total_rows or rows
+    first_second = SECONDS * first_row // max(total_rows, 1)
+    last_second = max(first_second + 1, SECONDS * (first_row + rows) // max(total_rows, 1))
+    start = FIRST_DAY + np.sort(rng.integers(first_second, last_second, rows)).astype('timedelta64[s]')
+    duration = np.maximum(60, rng.lognormal(6.5, 0.8, rows)).astype(np.int64)
+    end = start + duration.astype('timedelta64[s]')
+
+    df = pd.DataFrame({'Start Time': np.char.replace(np.datetime_as_string(start, unit='s'), 'T', ' '),
+                       'End Time': np.char.replace(np.datetime_as_string(end, unit='s'), 'T', ' '),
+                       'Trip Duration': duration if city != 'washington' else duration + rng.random(rows).round(3),
+                       # a few popular stations get most of the traffic
+                       'Start Station': stations[rng.zipf(1.3, rows) % STATIONS],
+                       'End Station': stations[rng.zipf(1.3, rows) % STATIONS],
+                       'User Type': rng.choice(np.array(['Subscriber', 'Customer', 'Dependent', None], dtype=object),
+                                               rows, p=[0.8, 0.18, 0.001, 0.019])},
+                      index=pd.RangeIndex(first_row, first_row + rows))
+    if city != 'washington':
+        df['Gender'] = rng.choice(np.array(['Male', 'Female', None], dtype=object), rows, p=[0.65, 0.2, 0.15])
+        birth_year = rng.normal(1981, 11, rows).round().clip(1900, 2002)
+        birth_year[rng.random(rows) < 0.15] = np.nan
+        df['Birth Year'] = birth_year
+    return df
+
+
+def write_trips(path, rows, city='chicago', seed=0):
+
+    """
+    Writes a synthetic city csv file, generating it chunk by chunk so any row count fits into memory.
+
+    Args:
+        (str) path - path of the csv file to write
+        (int) rows - number of trips to generate
+        (str) city - city whose schema to use
+        (int) seed - random seed
+    """
+    with open(path, 'w', newline='') as f:
+        for first_row in range(0, max(rows, 1), GENERATOR_CHUNK):
+            chunk = make_trips(min(GENERATOR_CHUNK, rows - first_row), city, seed, first_row, rows)
+            chunk.to_csv(f, header=first_row == 0)
+
+
+def measure(stage, fn, setup=None, memory=True):
+
+    """
+    Times one benchmark stage and tracks its peak memory.
+
+    The stage runs once for the time and, with memory tracking on, once more under tracemalloc so the tracing
+    overhead does not distort the timing.
+
+    Args:
+        (str) stage - name of the stage
+        fn - function running the stage, its return value is passed on
+        setup - optional function run before each run of the stage, e.g. to drop caches
+        (bool) memory - whether to track the peak memory
+    Returns:
+        (dict) record - stage, seconds and peak_bytes (None without memory tracking)
+        result - return value of fn
+    """
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'stage': stage, 'seconds': seconds, 'peak_bytes': peak}, result
+
+
+def run_benchmark(rows, city='chicago', seed=0, memory=True, workers=None, data_dir=None, scaling=(1, 2, 4)):
+
+    """
+    Generates a synthetic city file and times loading, aggregating and formatting it.
+
+    Args:
+        (int) rows - number of synthetic trips
+        (str) city - city whose schema and file name to use
+        (int) seed - random seed of the synthetic data
+        (bool) memory - whether to track the peak memory of every stage
+        (int) workers - worker processes for the cube build and the parallel stage
+        (str) data_dir - directory to generate the data in and keep it, a temporary directory by default
+        (list) scaling - worker counts to run the parallel stage with, to see how it scales with the workers
+    Returns:
+        (list) records - one record per stage with run information, seconds and peak_bytes
+    """
+    work_dir = data_dir or tempfile.mkdtemp(prefix='bikeshare_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    cwd = os.getcwd()
+    run = {'city': city, 'rows': rows, 'seed': seed, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+           'cpus': os.cpu_count()}
+    records = []
+
+    def record(stage, fn, setup=None, **extra):
+        entry, result = measure(stage, fn, setup, memory)
+        records.append(dict(run, **entry, **extra))
+        return result
+
+    # tracemalloc only sees the benchmark process, the memory of worker processes is not in peak_bytes
+    in_workers = {'peak_bytes_scope': 'main process only, workers not measured'}
+
+    def drop_cache():
+        shutil.rmtree(bikeshare_.CACHE_DIR, ignore_errors=True)
+
+    # the city file names are relative, so work inside the data directory (worker processes inherit it)
+    os.chdir(work_dir)
+    try:
+        path = bikeshare_.CITY_DATA[city]
+        if not os.path.exists(path) or data_dir is None:
+            write_trips(path, rows, city, seed)
+        run['csv_bytes'] = os.path.getsize(path)
+
+        record('load_data.cold', lambda: bikeshare_.load_data(city, 'all', 'all'), setup=drop_cache)
+        df = record('load_data.cached', lambda: bikeshare_.load_data(city, 'all', 'all'))
+        record('load_data.cached.june_monday', lambda: bikeshare_.load_data(city, 'june', 'monday'))
+        record('read_page.sunday', lambda: bikeshare_.read_page(city, 'all', 'sunday', page=1000))
+        stats = record('compute_stats', lambda: bikeshare_.compute_stats(df))
+        record('stream_stats', lambda: bikeshare_.stream_stats(city, 'all', 'all'))
+        record('parallel_stats', lambda: bikeshare_.parallel_stats(city, 'all', 'all', workers), **in_workers)
+        for count in scaling:
+            record('parallel_stats.workers_{}'.format(count),
+                   lambda count=count: bikeshare_.parallel_stats(city, 'all', 'all', count), workers=count,
+                   **in_workers)
+        # the cube is only built on worker processes with more than one of them
+        cube = record('build_cube', lambda: bikeshare_.build_cube(city, workers),
+                      **(in_workers if (workers or os.cpu_count() or 1) > 1 else {}))
+        record('cube_query', lambda: bikeshare_.summarize(bikeshare_.cube_aggregate(cube, 'all', 'all')))
+
+        for display in (bikeshare_.time_stats, bikeshare_.station_stats, bikeshare_.trip_duration_stats,
+                        bikeshare_.user_stats):
+            # time spent computing the statistics behind each display function within compute_stats
+            records.append(dict(run, stage='compute.' + display.__name__,
+                                seconds=bikeshare_.section_seconds(stats, display.__name__), peak_bytes=None))
+
+            # the display functions themselves only format, their output is discarded
+            def show(display=display):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    display(stats, city, 'all', 'all')
+            record('format.' + display.__name__, show)
+    finally:
+        os.chdir(cwd)
+        if data_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return records
+
+
+def compare(baseline, records, tolerance=0.2):
+
+    """
+    Compares benchmark records against a baseline run.
+
+    Args:
+        (list) baseline - records of an earlier run
+        (list) records - records of the current run
+        (float) tolerance - allowed relative slowdown (and memory growth) before a stage counts as regression
+    Returns:
+        (list) regressions - (rows, stage, metric, baseline value, current value) of every regressed stage
+    """
+    previous = {(entry['city'], entry['rows'], entry['stage']): entry for entry in baseline}
+    regressions = []
+    for entry in records:
+        old = previous.get((entry['city'], entry['rows'], entry['stage']))
+        if old is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if old.get(metric) and entry.get(metric) and entry[metric] > old[metric] * (1 + tolerance):
+                regressions.append((entry['rows'], entry['stage'], metric, old[metric], entry[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark bikeshare_.py on synthetic trip data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000],
+                        help='row counts to benchmark, e.g. 1000000 10000000 100000000 (default: 1000000)')
+    parser.add_argument('--city', choices=list(bikeshare_.CITY_DATA), default='chicago',
+                        help='city whose schema to generate (default: chicago)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--workers', type=int, help='worker processes for the cube build and parallel stage')
+    parser.add_argument('--scaling', type=int, nargs='*', default=[1, 2, 4],
+                        help='worker counts of the parallel scaling stages (default: 1 2 4)')
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory tracking (runs faster)')
+    parser.add_argument('--data-dir', help='generate the data in this directory and keep it between runs')
+    parser.add_argument('-o', '--output', help='append the JSON lines results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON lines results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown counted as regression when comparing (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    records = []
+    for rows in args.rows:
+        data_dir = os.path.join(args.data_dir, str(rows)) if args.data_dir else None
+        records += run_benchmark(rows, args.city, args.seed, not args.no_memory, args.workers, data_dir,
+                                 args.scaling)
+
+    lines = ''.join(json.dumps(entry) + '\n' for entry in records)
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare(baseline, records, args.tolerance)
+        for rows, stage, metric, old, new in regressions:
+            print('regression: {} rows, {} {} {:.4g} -> {:.4g}'.format(rows, stage, metric, old, new),
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
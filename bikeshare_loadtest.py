@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from urllib.parse import urlencode
+import numpy as np
+import bikeshare_
+
+# load test for bikeshare_service.py: keeps a number of concurrent keep alive connections busy with random
+# stats (and optionally top-K) queries for a while, then reports throughput and latency percentiles as JSON
+
+
+async def request(reader, writer, target, host):
+
+    """
+    Sends one GET request over an open connection and reads the answer.
+
+    Args:
+        reader - asyncio StreamReader of the connection
+        writer - asyncio StreamWriter of the connection
+        (str) target - path and query string to request
+        (str) host - value of the Host header
+    Returns:
+        (int) status - HTTP status code
+        (dict) body - decoded JSON body
+    """
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(target, host).encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+def random_target(rng, top_share=0.0, method='exact'):
+    """Returns the path of a random query, a top-K query with probability top_share."""
+    params = {'city': rng.choice(list(bikeshare_.CITY_DATA)), 'month': rng.choice(bikeshare_.MONTH_DATA),
+              'day': rng.choice(bikeshare_.WEEKDAY_DATA)}
+    if rng.random() < top_share:
+        return '/top?' + urlencode(dict(params, k=10, method=method))
+    return '/stats?' + urlencode(params)
+
+
+async def run_client(host, port, deadline, rng, latencies, failures, top_share, method):
+    """Sends queries over one connection until the deadline, recording the latency of every answer."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            target = random_target(rng, top_share, method)
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, target, host)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failures.append(target)
+    finally:
+        writer.close()
+
+
+async def load_test(host='127.0.0.1', port=8080, concurrency=16, duration=10.0, seed=0, top_share=0.0,
+                    method='exact'):
+
+    """
+    Runs the load test against a running service.
+
+    Args:
+        (str) host - address of the service
+        (int) port - port of the service
+        (int) concurrency - number of connections sending queries at the same time
+        (float) duration - seconds to send queries for
+        (int) seed - random seed of the query mix
+        (float) top_share - share of top-K queries in the query mix
+        (str) method - top-K method of the top-K queries
+    Returns:
+        (dict) report - requests, failures, throughput, client side latency percentiles (ms) and the metrics
+                        reported by the service afterwards
+    """
+    latencies = []
+    failures = []
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[run_client(host, port, deadline, random.Random(seed * 1000 + client), latencies,
+                                      failures, top_share, method)
+                           for client in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, service_metrics = await request(reader, writer, '/metrics', host)
+    finally:
+        writer.close()
+    values = np.array(latencies) * 1000
+    report = {'concurrency': concurrency, 'duration': elapsed, 'requests': len(latencies),
+              'failures': len(failures), 'throughput': len(latencies) / elapsed, 'latency_ms': None,
+              'service': service_metrics}
+    if len(values):
+        report['latency_ms'] = {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                                'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+                                'max': float(values.max())}
+    return report
+
+
+async def wait_until_up(host, port, timeout=600.0):
+    """Waits for a service that is starting up (and preloading the cities) to answer /health."""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            try:
+                if (await request(reader, writer, '/health', host))[0] == 200:
+                    return
+            finally:
+                writer.close()
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            if time.perf_counter() > deadline:
+                raise
+        await asyncio.sleep(0.2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test a local bikeshare_service.py instance.')
+    parser.add_argument('--host', default='127.0.0.1', help='address of the service (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port of the service (default: 8080)')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='concurrent connections (default: 16)')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='seconds to run (default: 10)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the query mix')
+    parser.add_argument('--top-share', type=float, default=0.0,
+                        help='share of top-K queries in the query mix (default: 0)')
+    parser.add_argument('--top-method', choices=bikeshare_.TOP_K_METHODS, default='exact',
+                        help='method of the top-K queries (default: exact)')
+    parser.add_argument('--spawn', action='store_true',
+                        help='start a service on the port for the test and stop it afterwards')
+    parser.add_argument('--workers', type=int, help='worker processes of the spawned service')
+    args = parser.parse_args(argv)
+
+    service = None
+    if args.spawn:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bikeshare_service.py'),
+                   '--host', args.host, '--port', str(args.port)]
+        if args.workers:
+            command += ['--workers', str(args.workers)]
+        service = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        # a spawned service first preloads every city, which can take a while on a cold cache
+        asyncio.run(wait_until_up(args.host, args.port, 600.0 if service is not None else 5.0))
+        report = asyncio.run(load_test(args.host, args.port, args.concurrency, args.duration, args.seed,
+                                       args.top_share, args.top_method))
+    finally:
+        if service is not None:
+            service.terminate()
+            service.wait()
+    print(json.dumps(report, indent=2))
+    return 1 if report['failures'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import bikeshare_
+
+# local HTTP/JSON service answering bikeshare_.py queries: every city is preloaded once and kept warm in the
+# worker processes (rollup cube in memory, columnar cache memory mapped), the event loop only parses requests,
+# coalesces identical ones and hands the aggregation to the workers; city files too large to load at once (see
+# bikeshare_.needs_streaming) are not preloaded but streamed per query, their results kept in the result cache
+#
+#   GET /stats?city=chicago&month=june&day=all      statistics of a query, see bikeshare_.stats_record
+#   GET /top?city=chicago&k=10&method=approx        popular stations and routes, see bikeshare_.top_k
+#   GET /metrics                                    request counts, latency percentiles and throughput
+#   GET /health                                     200 once the service is up
+
+# rollup cubes of the worker process by city, with the csv fingerprint they were built from
+WARM = {}
+
+# latencies (seconds) of the most recent requests per endpoint and finish times of recent requests, used for
+# the percentiles and the throughput reported by /metrics
+LATENCY_WINDOW = 10000
+THROUGHPUT_WINDOW = 60.0
+METRICS = {'started': time.time(), 'requests': 0, 'errors': 0, 'coalesced': 0, 'in_flight': 0}
+LATENCIES = {}
+FINISHED = deque(maxlen=LATENCY_WINDOW)
+
+# queries being answered right now by (endpoint, parameters), identical requests wait for the same answer
+IN_FLIGHT = {}
+
+# request bodies up to this size are read and dropped to keep the connection in sync, larger ones (and chunked
+# ones) close the connection after the answer
+MAX_BODY_BYTES = 1 << 20
+
+# largest k of a top-K query and smallest epsilon of an approximate one, both size the answer or the sketches
+MAX_TOP_K = 1000
+MIN_TOP_K_EPSILON = 1e-5
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+
+def warm_worker(cities):
+    """Loads the rollup cube of every city into the worker process, runs once per worker."""
+    for city in cities:
+        WARM[city] = (bikeshare_.source_fingerprint(city), bikeshare_.load_cube(city))
+
+
+def warm_cube(city):
+    """Returns the warm rollup cube of a city, reloading it if the csv file changed."""
+    fingerprint = bikeshare_.source_fingerprint(city)
+    if city not in WARM or WARM[city][0] != fingerprint:
+        WARM[city] = (fingerprint, bikeshare_.load_cube(city))
+    return WARM[city][1]
+
+
+def answer(endpoint, params):
+
+    """
+    Answers one query, runs in the worker processes.
+
+    Args:
+        (str) endpoint - "stats" or "top"
+        (tuple) params - city, month and day, for "top" also k, method and epsilon
+    Returns:
+        (dict) record - JSON serializable answer
+    """
+    city, month, day = params[:3]
+    if endpoint == 'stats':
+        return bikeshare_.stats_record(city, month, day, bikeshare_.summarize(warm_aggregate(city, month, day)))
+    k, method, epsilon = params[3:]
+    if method == 'exact':
+        top = bikeshare_.top_k_aggregate(warm_aggregate(city, month, day), k)
+    else:
+        top = bikeshare_.top_k(city, month, day, k, method, epsilon)
+    return bikeshare_.top_k_record(city, month, day, top)
+
+
+def warm_aggregate(city, month, day):
+    """Returns the aggregate of a query from the result cache or the warm cube of the worker process."""
+    fingerprint = bikeshare_.source_fingerprint(city)
+    agg = bikeshare_.cached_aggregate(city, month, day, fingerprint)
+    if agg is None:
+        if bikeshare_.needs_streaming(city):
+            agg = bikeshare_.stream_aggregate(city, month, day)
+        else:
+            agg = bikeshare_.cube_aggregate(warm_cube(city), month, day)
+        bikeshare_.store_aggregate(city, month, day, agg, fingerprint)
+    return agg
+
+
+def parse_params(endpoint, query):
+
+    """
+    Validates the query string of a request.
+
+    Args:
+        (str) endpoint - "stats" or "top"
+        (str) query - query string of the request url
+    Returns:
+        (tuple) params - city, month and day, for "top" also k, method and epsilon
+    """
+    fields = {key: values[-1] for key, values in parse_qs(query).items()}
+    params = bikeshare_.check_query(fields.get('city', ''), fields.get('month', 'all'), fields.get('day', 'all'))
+    if endpoint == 'stats':
+        return params
+    method = fields.get('method', 'exact')
+    if method not in bikeshare_.TOP_K_METHODS:
+        raise ValueError('unknown method {!r}, options are {}'.format(method, bikeshare_.TOP_K_METHODS))
+    k = int(fields.get('k', 10))
+    epsilon = float(fields.get('epsilon', bikeshare_.TOP_K_EPSILON))
+    if not 1 <= k <= MAX_TOP_K or not MIN_TOP_K_EPSILON <= epsilon < 1:
+        raise ValueError('k must be between 1 and {} and epsilon between {} and 1'.format(MAX_TOP_K,
+                                                                                          MIN_TOP_K_EPSILON))
+    return params + (k, method, epsilon)
+
+
+async def coalesced(pool, endpoint, params):
+    """Answers a query on the worker pool, sharing the answer with identical queries already in flight."""
+    key = (endpoint, params)
+    if key in IN_FLIGHT:
+        METRICS['coalesced'] += 1
+        return await asyncio.shield(IN_FLIGHT[key])
+    future = asyncio.get_running_loop().run_in_executor(pool, answer, endpoint, params)
+    IN_FLIGHT[key] = future
+    try:
+        return await asyncio.shield(future)
+    finally:
+        IN_FLIGHT.pop(key, None)
+
+
+def metrics():
+
+    """
+    Summarizes the requests served so far.
+
+    Returns:
+        (dict) metrics - request, error and coalesced counts, requests in flight, uptime, throughput over the
+                         last THROUGHPUT_WINDOW seconds and since start, latency percentiles (ms) per endpoint
+    """
+    now = time.time()
+    uptime = now - METRICS['started']
+    recent = sum(1 for finished in FINISHED if finished >= now - THROUGHPUT_WINDOW)
+    window = min(THROUGHPUT_WINDOW, uptime) or 1.0
+    record = dict(METRICS, uptime=uptime, throughput=recent / window, throughput_total=METRICS['requests'] / uptime,
+                  latency_ms={})
+    for endpoint, latencies in LATENCIES.items():
+        values = np.array(latencies) * 1000
+        record['latency_ms'][endpoint] = {'count': len(values), 'mean': float(values.mean()),
+                                          'p50': float(np.percentile(values, 50)),
+                                          'p90': float(np.percentile(values, 90)),
+                                          'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+    return record
+
+
+async def route(pool, method, target):
+    """Answers one request, returns the status code and the JSON serializable body."""
+    url = urlsplit(target)
+    endpoint = url.path.strip('/')
+    if endpoint not in ('stats', 'top', 'metrics', 'health'):
+        return 404, {'error': 'unknown path {!r}, options are /stats, /top, /metrics and /health'.format(url.path)}
+    if method != 'GET':
+        return 405, {'error': 'only GET is supported'}
+    if endpoint == 'health':
+        return 200, {'status': 'ok'}
+    if endpoint == 'metrics':
+        return 200, metrics()
+    try:
+        params = parse_params(endpoint, url.query)
+    except ValueError as error:
+        return 400, {'error': str(error)}
+    return 200, await coalesced(pool, endpoint, params)
+
+
+def response(status, body, keep_alive):
+    """Returns the bytes of an HTTP response with a JSON body."""
+    payload = json.dumps(body).encode()
+    return ('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'
+            .format(status, STATUS_TEXT[status], len(payload), 'keep-alive' if keep_alive else 'close').encode() +
+            payload)
+
+
+async def handle(pool, reader, writer):
+    """Serves the requests of one connection, keeping it open between requests (HTTP/1.1 keep alive)."""
+    try:
+        while True:
+            try:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+            except (ValueError, asyncio.LimitOverrunError):
+                # a line longer than the stream limit (64 KiB): the end of the request cannot be found, so answer
+                # and close the connection
+                writer.write(response(400, {'error': 'request line or header too long'}, False))
+                await writer.drain()
+                break
+
+            # no endpoint takes a body: skip it, or stop reading from the connection if it cannot be skipped
+            body_ok = 'transfer-encoding' not in headers
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length, body_ok = 0, False
+            if length > MAX_BODY_BYTES or length < 0:
+                body_ok = False
+            elif length and body_ok:
+                await reader.readexactly(length)
+
+            start = time.perf_counter()
+            parts = request_line.decode('latin-1').split()
+            if len(parts) != 3:
+                status, body, endpoint = 400, {'error': 'malformed request line'}, 'invalid'
+            else:
+                method, target, version = parts
+                endpoint = urlsplit(target).path.strip('/') or '/'
+                METRICS['in_flight'] += 1
+                try:
+                    status, body = await route(pool, method, target)
+                except Exception as error:
+                    status, body = 500, {'error': '{}: {}'.format(type(error).__name__, error)}
+                finally:
+                    METRICS['in_flight'] -= 1
+            keep_alive = body_ok and len(parts) == 3 and (headers.get('connection', '').lower() != 'close' and
+                                              (version == 'HTTP/1.1' or
+                                               headers.get('connection', '').lower() == 'keep-alive'))
+
+            writer.write(response(status, body, keep_alive))
+            await writer.drain()
+
+            # metrics are only kept for the query endpoints, not for scraping them
+            if endpoint in ('stats', 'top'):
+                LATENCIES.setdefault(endpoint, deque(maxlen=LATENCY_WINDOW)).append(time.perf_counter() - start)
+                FINISHED.append(time.time())
+                METRICS['requests'] += 1
+                METRICS['errors'] += status != 200
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=8080, workers=None, cities=None):
+
+    """
+    Preloads the cities and serves queries until the process is stopped.
+
+    Args:
+        (str) host - address to listen on
+        (int) port - port to listen on
+        (int) workers - number of worker processes, defaults to the number of cpus
+        (list) cities - cities to preload, defaults to all cities, others are loaded on their first query
+    """
+    cities = list(bikeshare_.CITY_DATA) if cities is None else cities
+    # city files too large to load at once cannot be turned into a cube, their queries are streamed
+    cities = [city for city in cities if not bikeshare_.needs_streaming(city)]
+    workers = workers or os.cpu_count() or 1
+    # build missing caches and cubes once here, so the workers only load them
+    for city in cities:
+        bikeshare_.load_cube(city)
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(cities,)) as pool:
+        # start every worker now instead of on the first queries
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(pool, time.sleep, 0.1) for _ in range(workers)])
+        server = await asyncio.start_server(lambda reader, writer: handle(pool, reader, writer), host, port)
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        print('serving on http://{}:{} with {} workers'.format(host, port, workers), flush=True)
+        METRICS['started'] = time.time()
+        async with server:
+            await stop.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve bikeshare statistics as JSON over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--workers', type=int, help='worker processes answering queries (default: cpus)')
+    parser.add_argument('--city', action='append', choices=list(bikeshare_.CITY_DATA),
+                        help='city to preload, may be repeated (default: all cities)')
+    parser.add_argument('--trace', metavar='FILE', help='append a JSON line per instrumented span to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        bikeshare_.enable_trace(args.trace)
+    asyncio.run(serve(args.host, args.port, args.workers, args.city))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import os
+import shutil
+from collections import OrderedDict
+import pytest
+import pandas as pd
+import bikeshare_
+import bikeshare_bench
+
+# tests of bikeshare_.py on small synthetic city files (see bikeshare_bench.make_trips), run with python -m pytest
+
+
+@pytest.fixture
+def city(tmp_path, monkeypatch):
+    """Works in an empty directory holding a small synthetic Chicago file, with empty caches."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bikeshare_, 'RESULT_CACHE', OrderedDict())
+    bikeshare_bench.write_trips(bikeshare_.CITY_DATA['chicago'], 2000)
+    return 'chicago'
+
+
+# chunks of less than a day of trips for day filters and of a few days for month filters, so both leave many
+# of them empty, the first ones included
+@pytest.mark.parametrize('month, day, chunksize', [('all', 'all', 100), ('all', 'monday', 8), ('june', 'all', 50),
+                                                   ('march', 'friday', 8)])
+def test_stream_matches_memory(city, month, day, chunksize):
+    streamed = bikeshare_.stream_stats(city, month, day, chunksize)
+    loaded = bikeshare_.compute_stats(bikeshare_.load_data(city, month, day))
+    assert bikeshare_.stats_record(city, month, day, streamed) == bikeshare_.stats_record(city, month, day, loaded)
+    # float labels would still compare equal to integer ones
+    assert type(streamed['popular_hour']) is type(loaded['popular_hour'])
+
+
+def test_batch_streams_large_files(city, monkeypatch):
+    queries = [(city, 'all', 'all'), (city, 'march', 'all'), (city, 'all', 'friday')]
+    expected = bikeshare_.run_batch(queries, mode='memory')
+    shutil.rmtree(bikeshare_.CACHE_DIR)
+    # every file counts as too large to load: no mode may parse it at once into the columnar cache
+    monkeypatch.setattr(bikeshare_, 'STREAM_THRESHOLD_BYTES', 0)
+    for mode in bikeshare_.BATCH_MODES:
+        monkeypatch.setattr(bikeshare_, 'RESULT_CACHE', OrderedDict())
+        assert bikeshare_.run_batch(queries, mode=mode) == expected
+        assert not os.path.exists(bikeshare_.city_cache_dir(city))
+
+
+def write_city(path, start_times, end_times):
+    """Writes a small hand made city file with one trip per start time."""
+    rows = len(start_times)
+    pd.DataFrame({'Start Time': start_times, 'End Time': end_times, 'Trip Duration': [600] * rows,
+                  'Start Station': ['A'] * rows, 'End Station': ['B'] * rows, 'User Type': ['Subscriber'] * rows,
+                  'Gender': ['Female'] * rows, 'Birth Year': [1990.0] * rows}).to_csv(path)
+
+
+@pytest.mark.parametrize('mode', bikeshare_.QUERY_MODES)
+def test_missing_start_times_are_not_counted(tmp_path, monkeypatch, mode):
+    monkeypatch.chdir(tmp_path)
+    write_city(bikeshare_.CITY_DATA['chicago'], ['2017-01-03 09:00:00', None, None, None],
+               ['2017-01-03 09:10:00', None, None, None])
+    stats = bikeshare_.get_stats('chicago', mode=mode, cache=False)
+    # rows without a start time count as trips, but have no month, day or hour
+    assert stats['rows'] == 4
+    assert (stats['popular_month'], stats['popular_day'], stats['popular_hour']) == (1, 'Tuesday', 9)
+    assert bikeshare_.get_stats('chicago', day='monday', mode=mode, cache=False)['rows'] == 0
+
+
+def test_bad_end_times_are_left_missing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_city(bikeshare_.CITY_DATA['chicago'], ['2017-01-03 09:00:00', '2017-01-04 10:00:00'],
+               ['2017-01-03 09:10:00', 'garbage'])
+    df = bikeshare_.load_data('chicago', 'all', 'all')
+    assert len(df) == 2
+    assert df['End Time'].isna().tolist() == [False, True]
+
+
+def test_all_queries_are_derived_from_cached_months(city, monkeypatch):
+    expected = bikeshare_.stats_record(city, 'all', 'all', bikeshare_.get_stats(city, cache=False))
+    for month in bikeshare_.MONTH_DATA[:-1]:
+        bikeshare_.get_stats(city, month)
+
+    def not_cached(*args):
+        raise AssertionError('computed instead of derived from the cached months')
+    monkeypatch.setattr(bikeshare_, 'cube_aggregate', not_cached)
+    assert bikeshare_.stats_record(city, 'all', 'all', bikeshare_.get_stats(city)) == expected
+
+
+def test_all_queries_are_not_derived_from_incomplete_months(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bikeshare_, 'RESULT_CACHE', OrderedDict())
+    # a july trip and one without a start time are in no month query
+    write_city(bikeshare_.CITY_DATA['chicago'], ['2017-01-03 09:00:00', '2017-07-04 10:00:00', None],
+               ['2017-01-03 09:10:00', '2017-07-04 10:10:00', None])
+    for month in bikeshare_.MONTH_DATA[:-1]:
+        bikeshare_.get_stats('chicago', month)
+    assert bikeshare_.get_stats('chicago')['rows'] == 3
+
+
+def test_unreadable_result_files_are_misses(city, tmp_path):
+    bikeshare_.enable_result_cache(str(tmp_path / 'results'))
+    try:
+        expected = bikeshare_.stats_record(city, 'june', 'all', bikeshare_.get_stats(city, 'june'))
+        bikeshare_.RESULT_CACHE.clear()
+        # cut off like by a crash or a copy in progress
+        path = bikeshare_.result_cache_path(city, 'june', 'all')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        assert bikeshare_.stats_record(city, 'june', 'all', bikeshare_.get_stats(city, 'june')) == expected
+    finally:
+        bikeshare_.enable_result_cache()
+
+
+def test_readers_keep_their_cache_build_while_it_is_rebuilt(city):
+    meta = bikeshare_.ensure_cache(city)
+    ranges = bikeshare_.select_partitions(meta, 'june', 'all')
+    expected = bikeshare_.read_ranges(city, meta, ranges)
+    # another process rebuilds the cache of the changed csv file while this one still uses the old metadata
+    bikeshare_bench.write_trips(bikeshare_.CITY_DATA[city], 3000, seed=1)
+    assert bikeshare_.ensure_cache(city)['build'] != meta['build']
+    pd.testing.assert_frame_equal(bikeshare_.read_ranges(city, meta, ranges), expected)
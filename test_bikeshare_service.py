@@ -0,0 +1,36 @@
+import json
+import asyncio
+import bikeshare_service
+
+# tests of the request handling of bikeshare_service.py, on a server without worker pool (no query reaches it)
+
+
+async def exchange(request):
+    """Sends raw request bytes to a fresh server and returns the status, the body and the Connection header."""
+    server = await asyncio.start_server(lambda reader, writer: bikeshare_service.handle(None, reader, writer),
+                                        '127.0.0.1', 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(request)
+        await writer.drain()
+        head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        headers = dict(line.lower().split(': ', 1) for line in head[1:] if line)
+        body = json.loads(await reader.readexactly(int(headers['content-length'])))
+        writer.close()
+    return int(head[0].split()[1]), body, headers['connection']
+
+
+def test_too_long_request_lines_are_bad_requests():
+    status, body, connection = asyncio.run(exchange(b'GET /stats?city=' + b'x' * 100000 + b' HTTP/1.1\r\n\r\n'))
+    assert (status, connection) == (400, 'close')
+
+
+def test_too_long_headers_are_bad_requests():
+    status, body, connection = asyncio.run(exchange(b'GET /health HTTP/1.1\r\nX-Long: ' + b'x' * 100000 + b'\r\n\r\n'))
+    assert (status, connection) == (400, 'close')
+
+
+def test_top_k_is_bounded():
+    status, body, connection = asyncio.run(exchange(b'GET /top?city=chicago&k=100000000 HTTP/1.1\r\n\r\n'))
+    assert status == 400
+    assert str(bikeshare_service.MAX_TOP_K) in body['error']